@@ -0,0 +1,134 @@
+# encoding:utf-8
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    相同 key 的并发调用只执行一次，所有调用方共享同一个结果（或异常）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def do(self, key, fn, on_join=None):
+        """
+        执行 fn，如果相同 key 的调用正在进行，则等待并复用其结果
+
+        :param on_join: 加入已有调用时的回调（在等待前调用）
+        :return: (结果, 是否复用了其他调用的结果)
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+
+        if not leader:
+            if on_join:
+                on_join()
+            return future.result(), True
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return future.result(), False
+
+    def inflight_count(self):
+        with self._lock:
+            return len(self._inflight)
+
+
+class AdmissionController:
+    """
+    总结任务准入控制：限制全局和单个会话同时运行的任务数，超出时按先后顺序排队
+
+    排在前面但因会话限制无法运行的任务不会阻塞其他会话的任务
+    """
+
+    def __init__(self, global_limit=3, session_limit=1, max_queue=10):
+        self.global_limit = global_limit
+        self.session_limit = session_limit
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        self._running_total = 0
+        self._running = {}
+        self._queue = deque()
+
+    def _can_run(self, session_id):
+        return (self._running_total < self.global_limit
+                and self._running.get(session_id, 0) < self.session_limit)
+
+    def _is_next(self, ticket):
+        """ticket 是否是队列中第一个可以运行的任务"""
+        for queued_ticket, session_id in self._queue:
+            if self._can_run(session_id):
+                return queued_ticket is ticket
+        return False
+
+    def _position(self, ticket):
+        """排队位置（从1开始）：只计算排在前面、不受本会话限制阻塞的任务"""
+        position = 1
+        for queued_ticket, session_id in self._queue:
+            if queued_ticket is ticket:
+                break
+            if self._running.get(session_id, 0) < self.session_limit:
+                position += 1
+        return position
+
+    def _admit(self, session_id):
+        self._running_total += 1
+        self._running[session_id] = self._running.get(session_id, 0) + 1
+
+    def acquire(self, session_id, on_queued=None, timeout=None):
+        """
+        申请运行名额，名额不足时排队等待
+
+        :param on_queued: 需要排队时的回调，参数为排队位置（从1开始），在等待前调用
+        :param timeout: 最长等待秒数
+        :return: True 获得名额；False 队列已满或等待超时
+        """
+        ticket = object()
+        with self._cond:
+            # 排在前面的任务都因会话限制无法运行时直接运行，不必排队
+            if self._can_run(session_id) and not any(self._can_run(queued) for _, queued in self._queue):
+                self._admit(session_id)
+                return True
+            if len(self._queue) >= self.max_queue:
+                return False
+            self._queue.append((ticket, session_id))
+            position = self._position(ticket)
+
+        if on_queued:
+            on_queued(position)
+
+        with self._cond:
+            admitted = self._cond.wait_for(lambda: self._is_next(ticket), timeout=timeout)
+            self._queue.remove((ticket, session_id))
+            if admitted:
+                self._admit(session_id)
+            # 队列变化后其他等待者可能可以运行了
+            self._cond.notify_all()
+            return admitted
+
+    def release(self, session_id):
+        """释放运行名额"""
+        with self._cond:
+            self._running_total -= 1
+            self._running[session_id] -= 1
+            if not self._running[session_id]:
+                del self._running[session_id]
+            self._cond.notify_all()
+
+    def status(self):
+        """(运行中的任务数, 排队中的任务数)"""
+        with self._cond:
+            return self._running_total, len(self._queue)
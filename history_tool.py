@@ -0,0 +1,296 @@
+# encoding:utf-8
+"""
+聊天记录批量导入/导出工具（离线使用，请先停止机器人）
+
+在 chatgpt-on-wechat 根目录下运行：
+    python -m plugins.summary.history_tool import history.jsonl
+    python -m plugins.summary.history_tool import history.csv --session 测试群
+    python -m plugins.summary.history_tool export backup.jsonl --session 测试群 --since 1700000000
+    python -m plugins.summary.history_tool tokens --session 测试群
+
+导入文件每行（JSONL）或每列（CSV 表头）支持的字段：
+    sessionid  会话ID（群名/用户昵称），可用 --session 统一指定
+    msgid      消息ID，缺省时根据内容生成
+    user       发送者昵称
+    content    消息内容，会按实时接收消息相同的规则去除 XML 等冗余信息
+    type       消息类型，默认 TEXT
+    timestamp  Unix 时间戳或 "%Y-%m-%d %H:%M:%S" 格式时间
+    is_triggered 是否触发了机器人，默认 0
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+
+from common.log import logger
+
+from .normalize import is_command_message, normalize_content
+from .segmenter import TopicSegmenter
+from .storage import (BLOB_MIN_LENGTH, BlobCache, ChatStore, create_record_indexes, drop_record_indexes, gc_blobs,
+                      init_schema, rebuild_hourly_stats, store_content)
+from .transcript import record_text, render_transcript
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(__file__), "chat.db")
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.json")
+RECORD_COLUMNS = ("sessionid", "msgid", "user", "content", "type", "timestamp", "is_triggered")
+
+
+def load_plugin_config(path):
+    """读取插件的 config.json，导入时使用与实时写入相同的话题划分和长内容存储参数"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _parse_timestamp(value):
+    """解析 Unix 时间戳或 "%Y-%m-%d %H:%M:%S" 格式时间"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip()
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(time.mktime(time.strptime(value, "%Y-%m-%d %H:%M:%S")))
+
+
+def _generate_msgid(session_id, timestamp, user, content):
+    """为缺少消息ID的记录生成稳定的ID，重复导入同一文件不会产生重复记录"""
+    digest = hashlib.sha1(f"{session_id}|{timestamp}|{user}|{content}".encode("utf-8")).hexdigest()
+    return int(digest[:15], 16)
+
+
+def _read_rows(path, fmt):
+    """逐行读取导入文件，返回字典迭代器"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if fmt == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"[Summary] 第 {line_no} 行 JSON 解析失败，已跳过: {e}")
+
+
+def normalize_row(row, session_id=None):
+    """
+    将导入的一行转换为 chat_records 记录，规则与 on_receive_message 一致
+
+    :return: 记录元组，需要过滤的消息返回 None
+    """
+    session_id = session_id or row.get("sessionid") or row.get("session_id")
+    content = row.get("content")
+    if not session_id or content is None or row.get("timestamp") in (None, ""):
+        return None
+
+    content = normalize_content(str(content))
+    if is_command_message(content):
+        return None
+
+    user = row.get("user") or ""
+    timestamp = _parse_timestamp(row["timestamp"])
+    msg_id = row.get("msgid")
+    if msg_id in (None, ""):
+        msg_id = row.get("msg_id")
+    msg_id = int(msg_id) if msg_id not in (None, "") else _generate_msgid(session_id, timestamp, user, content)
+    is_triggered = int(str(row.get("is_triggered") or 0).lower() in ("1", "true"))
+    return session_id, msg_id, user, content, row.get("type") or "TEXT", timestamp, is_triggered
+
+
+def import_history(store, path, fmt="jsonl", session_id=None, batch_size=50000, config=None):
+    """
+    批量导入聊天记录
+
+    :param config: 插件配置，话题划分参数（segment_*、chunk_max_tokens）和 blob_min_length 与实时写入保持一致
+
+    导入期间删除二级索引，每 batch_size 条使用一次 executemany 并在一个事务中提交，
+    导入完成后重建索引，以及相关会话的小时统计和话题段
+
+    :return: (导入条数, 跳过条数)
+    """
+    config = config or {}
+    blob_min_length = config.get("blob_min_length", BLOB_MIN_LENGTH)
+    imported = skipped = 0
+    sessions = set()
+    batch = []
+
+    def flush():
+        with store.write() as conn:
+            rows = []
+            for record in batch:
+                # 长内容存入 chat_blobs，与实时写入相同
+                content, content_ref = store_content(conn, record[3], blob_min_length)
+                rows.append(record[:3] + (content,) + record[4:] + (content_ref,))
+            conn.executemany(f"INSERT OR REPLACE INTO chat_records ({','.join(RECORD_COLUMNS)},content_ref) "
+                             "VALUES (?,?,?,?,?,?,?,?)", rows)
+        batch.clear()
+
+    with store.write() as conn:
+        init_schema(conn)
+        drop_record_indexes(conn)
+    try:
+        for row in _read_rows(path, fmt):
+            try:
+                record = normalize_row(row, session_id)
+            except (ValueError, TypeError) as e:
+                logger.warning(f"[Summary] 记录格式错误，已跳过: {e}")
+                record = None
+            if record is None:
+                skipped += 1
+                continue
+            batch.append(record)
+            sessions.add(record[0])
+            imported += 1
+            if len(batch) >= batch_size:
+                flush()
+                logger.info(f"[Summary] 已导入 {imported} 条记录")
+        if batch:
+            flush()
+    finally:
+        with store.write() as conn:
+            create_record_indexes(conn)
+            rebuild_hourly_stats(conn, sessions)
+            TopicSegmenter.from_config(config).rebuild(conn, sessions)
+            gc_blobs(conn)
+    return imported, skipped
+
+
+def export_history(store, out, session_id=None, since=0):
+    """
+    流式导出聊天记录为 JSONL，逐行读取写出，内存占用与记录总数无关
+
+    :return: 导出条数
+    """
+    sql = f"SELECT {','.join(RECORD_COLUMNS)},content_ref FROM chat_records WHERE timestamp>?"
+    params = [since]
+    if session_id:
+        sql += " AND sessionid=?"
+        params.append(session_id)
+    sql += " ORDER BY sessionid, timestamp"
+
+    count = 0
+    blob_cache = BlobCache()
+    with store.read() as conn:
+        for row in conn.execute(sql, params):
+            row, content_ref = row[:-1], row[-1]
+            if content_ref:
+                row = row[:3] + (blob_cache.get(conn, content_ref),) + row[4:]
+            out.write(json.dumps(dict(zip(RECORD_COLUMNS, row)), ensure_ascii=False))
+            out.write("\n")
+            count += 1
+    return count
+
+
+def _token_counter():
+    """返回 (计数函数, 说明)，安装了 tiktoken 时使用 cl100k_base 编码精确计数，否则按 4 个字符约 1 个 token 估算"""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return (lambda text: len(encoding.encode(text))), "tiktoken cl100k_base"
+    except Exception:
+        return (lambda text: len(text) // 4), "字符数/4 估算"
+
+
+def _legacy_transcript(records):
+    """旧版聊天记录格式（每行完整时间戳和昵称），作为 token 对比的基准"""
+    lines = []
+    for record in records:
+        time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record[5]))
+        line = f'[{time_str}] {record[2] or ""}: "{record_text(record)}"'
+        if record[6]:
+            line += " <T>"
+        lines.append(line)
+    return "\n\n".join(lines)
+
+
+def token_report(store, out, session_id=None, since=0):
+    """
+    对比旧版格式和紧凑格式的聊天记录 token 数，按会话输出
+
+    :return: (旧版 token 总数, 紧凑格式 token 总数)
+    """
+    count_tokens, method = _token_counter()
+    sql = "SELECT DISTINCT sessionid FROM chat_records WHERE timestamp>?"
+    params = [since]
+    if session_id:
+        sql += " AND sessionid=?"
+        params.append(session_id)
+
+    legacy_total = compact_total = 0
+    blob_cache = BlobCache()
+    out.write(f"计数方式：{method}\n")
+    out.write(f"{'会话':<20}{'消息数':>10}{'旧版':>12}{'紧凑':>12}{'减少':>8}\n")
+    with store.read() as conn:
+        for (sid,) in conn.execute(sql, params).fetchall():
+            records = blob_cache.resolve(conn, conn.execute("SELECT * FROM chat_records WHERE sessionid=? AND timestamp>? "
+                                                            "ORDER BY timestamp, rowid", (sid, since)).fetchall())
+            groups = []
+            for record in records:
+                if groups and groups[-1][0] == record[7]:
+                    groups[-1][1].append(record)
+                else:
+                    groups.append((record[7], [record]))
+            legacy = count_tokens(_legacy_transcript(records))
+            compact = count_tokens(render_transcript(groups))
+            legacy_total += legacy
+            compact_total += compact
+            saved = 1 - compact / legacy if legacy else 0
+            out.write(f"{sid:<20}{len(records):>10}{legacy:>12}{compact:>12}{saved:>8.1%}\n")
+    saved = 1 - compact_total / legacy_total if legacy_total else 0
+    out.write(f"{'合计':<20}{'':>10}{legacy_total:>12}{compact_total:>12}{saved:>8.1%}\n")
+    return legacy_total, compact_total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="聊天记录批量导入/导出工具")
+    parser.add_argument("--db", help="数据库路径，默认为插件配置中的 db_path 或插件目录下的 chat.db")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH, help="插件配置文件，默认为插件目录下的 config.json")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="从 JSONL/CSV 文件导入聊天记录")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--format", choices=("jsonl", "csv"), help="文件格式，默认根据扩展名判断")
+    import_parser.add_argument("--session", help="将所有记录导入到指定会话")
+    import_parser.add_argument("--batch-size", type=int, default=50000)
+
+    export_parser = subparsers.add_parser("export", help="流式导出聊天记录为 JSONL")
+    export_parser.add_argument("path", help="输出文件，- 表示标准输出")
+    export_parser.add_argument("--session", help="只导出指定会话")
+    export_parser.add_argument("--since", type=int, default=0, help="只导出该时间戳之后的记录")
+
+    tokens_parser = subparsers.add_parser("tokens", help="对比旧版和紧凑格式聊天记录的 token 数")
+    tokens_parser.add_argument("--session", help="只统计指定会话")
+    tokens_parser.add_argument("--since", type=int, default=0, help="只统计该时间戳之后的记录")
+
+    args = parser.parse_args(argv)
+    config = load_plugin_config(args.config)
+    store = ChatStore(args.db or config.get("db_path") or DEFAULT_DB_PATH)
+    try:
+        start = time.time()
+        if args.command == "import":
+            fmt = args.format or ("csv" if args.path.lower().endswith(".csv") else "jsonl")
+            imported, skipped = import_history(store, args.path, fmt, args.session, args.batch_size, config)
+            print(f"导入完成：{imported} 条，跳过 {skipped} 条，耗时 {time.time() - start:.1f}s", file=sys.stderr)
+        elif args.command == "tokens":
+            token_report(store, sys.stdout, args.session, args.since)
+        else:
+            if args.path == "-":
+                count = export_history(store, sys.stdout, args.session, args.since)
+            else:
+                with open(args.path, "w", encoding="utf-8") as f:
+                    count = export_history(store, f, args.session, args.since)
+            print(f"导出完成：{count} 条，耗时 {time.time() - start:.1f}s", file=sys.stderr)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
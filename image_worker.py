@@ -0,0 +1,47 @@
+# encoding:utf-8
+"""
+图片预处理，在独立的进程池中运行，避免 CPU 密集的解码/缩放/编码占用主进程的 GIL
+
+本模块只依赖 PIL，子进程中的错误以返回值的形式交给主进程记录日志。
+spawn 子进程启动时会重新导入主进程的 __main__（机器人框架的入口）和本模块所在的插件包，
+启动成本较高，因此进程池按需创建后一直复用
+"""
+
+import os
+import time
+from io import BytesIO
+
+from PIL import Image
+
+MAX_IMAGE_SIZE = (2048, 2048)
+MAX_IMAGE_BYTES = 1 * 1024 * 1024
+
+
+def resize_and_encode_image(image_path):
+    """
+    将图片调整大小并重新编码为 JPEG
+
+    :param image_path: 图片路径
+    :return: (JPEG 字节或 None, 错误信息或 None, 处理耗时秒数)
+    """
+    start = time.perf_counter()
+    try:
+        img = Image.open(image_path)
+
+        # 将图片转换为 RGB 模式，去除 alpha 通道
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        img.thumbnail(MAX_IMAGE_SIZE)
+
+        buffer = BytesIO()
+        # 检查图片大小，如果超过 1M 就尝试降低质量
+        if os.path.getsize(image_path) > MAX_IMAGE_BYTES:
+            img.save(buffer, format="JPEG", quality=80)  # 降低质量
+            if buffer.tell() > MAX_IMAGE_BYTES:  # 降低质量后仍超过1M，直接放弃
+                return None, "图片太大", time.perf_counter() - start
+        else:
+            img.save(buffer, format="JPEG")
+        return buffer.getvalue(), None, time.perf_counter() - start
+    except Exception as e:
+        return None, str(e), time.perf_counter() - start
@@ -0,0 +1,109 @@
+# encoding:utf-8
+
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class SummaryJobManager:
+    """
+    后台总结任务：提交后立即返回任务ID，在独立的线程池中执行，状态和结果保存在 summary_jobs 表中
+
+    重启时未完成的任务标记为失败（不自动重跑，避免重复调用 LLM）
+    """
+
+    def __init__(self, store, workers=3, retention_days=7):
+        self.store = store
+        self.retention_seconds = retention_days * 86400
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="summary_job")
+        self._lock = threading.Lock()
+        self._active = 0
+
+    def recover(self):
+        """启动时调用：将上次运行中断的任务标记为失败，并清理过期任务"""
+        now = int(time.time())
+        with self.store.write() as conn:
+            c = conn.execute("UPDATE summary_jobs SET status=?, error=?, updated_at=? WHERE status IN (?,?)",
+                             (FAILED, "服务重启，任务已中断，请重新提交", now, QUEUED, RUNNING))
+            if c.rowcount:
+                logger.warning(f"[Summary] {c.rowcount} 个未完成的总结任务因重启被标记为失败")
+            conn.execute("DELETE FROM summary_jobs WHERE updated_at<?", (now - self.retention_seconds,))
+
+    def submit(self, session_id, requester, params, run, on_finish=None):
+        """
+        提交任务
+
+        :param session_id: 被总结的会话
+        :param requester: 发起请求的会话，只有该会话可以查询结果
+        :param params: 任务参数（保存为 JSON，便于排查）
+        :param run: 执行总结的函数，返回总结文本，失败时抛出异常
+        :param on_finish: 任务结束后的回调，参数为任务信息（见 get）
+        :return: 任务ID
+        """
+        job_id = uuid.uuid4().hex[:8]
+        now = int(time.time())
+        with self.store.write() as conn:
+            conn.execute("INSERT INTO summary_jobs (job_id, sessionid, requester, params, status, created_at, updated_at) "
+                         "VALUES (?,?,?,?,?,?,?)",
+                         (job_id, session_id, requester, json.dumps(params, ensure_ascii=False), QUEUED, now, now))
+        with self._lock:
+            self._active += 1
+        self._executor.submit(self._execute, job_id, run, on_finish)
+        return job_id
+
+    def _set_status(self, job_id, status, result=None, error=None):
+        with self.store.write() as conn:
+            conn.execute("UPDATE summary_jobs SET status=?, result=?, error=?, updated_at=? WHERE job_id=?",
+                         (status, result, error, int(time.time()), job_id))
+
+    def _execute(self, job_id, run, on_finish):
+        try:
+            self._set_status(job_id, RUNNING)
+            try:
+                self._set_status(job_id, DONE, result=run())
+            except Exception as e:
+                logger.error(f"[Summary] 总结任务 {job_id} 失败: {e}")
+                self._set_status(job_id, FAILED, error=str(e))
+            if on_finish:
+                on_finish(self.get(job_id))
+        except Exception as e:
+            logger.error(f"[Summary] 总结任务 {job_id} 处理异常: {e}")
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def get(self, job_id, requester=None):
+        """
+        查询任务
+
+        :param requester: 指定时只返回该会话发起的任务
+        :return: dict(job_id, sessionid, status, result, error, created_at, updated_at)，不存在时返回 None
+        """
+        sql = "SELECT job_id, sessionid, status, result, error, created_at, updated_at FROM summary_jobs WHERE job_id=?"
+        params = [job_id]
+        if requester is not None:
+            sql += " AND requester=?"
+            params.append(requester)
+        rows = self.store.query(sql, params)
+        if not rows:
+            return None
+        return dict(zip(("job_id", "sessionid", "status", "result", "error", "created_at", "updated_at"), rows[0]))
+
+    def recent(self, requester, limit=5):
+        """发起会话最近的任务，最新的在前：[(job_id, sessionid, status, created_at), ...]"""
+        return self.store.query("SELECT job_id, sessionid, status, created_at FROM summary_jobs WHERE requester=? "
+                                "ORDER BY created_at DESC LIMIT ?", (requester, limit))
+
+    def active_count(self):
+        """排队和运行中的任务数"""
+        with self._lock:
+            return self._active
@@ -4,24 +4,38 @@ import asyncio
 import json
 import os
 import time
-import sqlite3
 import requests
 from urllib.parse import urlparse
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 import base64
-from io import BytesIO
-from PIL import Image
 import shutil
-import re  # 导入正则表达式模块
+import uuid
 
 import plugins
-from bridge.context import ContextType
+from bridge.bridge import Bridge
+from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import check_contain, check_prefix
 from channel.chat_message import ChatMessage
 from common.log import logger
 from plugins import *
-import xml.etree.ElementTree as ET
+
+from .concurrency import AdmissionController, SingleFlight
+from .image_worker import resize_and_encode_image
+from .jobs import DONE, FAILED, QUEUED, RUNNING, SummaryJobManager
+from .normalize import extract_quoted_user, is_command_message, normalize_content
+from .pyramid import SummaryPyramid, format_period, invalidate_periods, period_start, tile
+from .recorder import EventRecorder
+from .segmenter import TopicSegmenter
+from .storage import BLOB_MIN_LENGTH, BlobCache, ChatStore, gc_blobs, init_schema, store_content, update_hourly_stats
+from .tailcache import TailCache
+from .transcript import SPEAKER_HEADER, estimate_line_length, estimate_speaker_length, render_transcript
+
+class SummaryError(Exception):
+    """总结过程中需要直接回复给用户的错误"""
+
 
 @plugins.register(
     name="Summary",
@@ -29,7 +43,7 @@ import xml.etree.ElementTree as ET
     hidden=False,
     enabled=True,
     desc="聊天记录总结助手",
-    version="1.6.4",
+    version="1.7.0",
     author="sofs2005",
 )
 class Summary(Plugin):
@@ -60,7 +74,7 @@ class Summary(Plugin):
     ………
 
 聊天记录格式：
-[x]是emoji表情或者是对图片和声音文件的说明，消息最后出现<T>表示消息触发了群聊机器人的回复，内容通常是提问，若带有特殊符号如#和$则是触发你无法感知的某个插件功能，聊天记录中不包含你对这类消息的回复，可降低这些消息的权重。请不要在回复中包含聊天记录格式中出现的符号。
+开头的发言人表给出了发言人代号与昵称的对应关系，总结中请使用昵称；## 开头的行是日期，每条消息格式为“时:分 发言人代号: 内容”；【话题N】是预先按时间间隔和发言人划分的话题边界，可作为划分Topic的参考；[x]是emoji表情或者是对图片和声音文件的说明，消息最后出现<T>表示消息触发了群聊机器人的回复，内容通常是提问，若带有特殊符号如#和$则是触发你无法感知的某个插件功能，聊天记录中不包含你对这类消息的回复，可降低这些消息的权重。请不要在回复中包含聊天记录格式中出现的符号。
 
 '''
     default_image_prompt = """
@@ -69,6 +83,33 @@ class Summary(Plugin):
 如果是文字截图，只关注文字内容，不用描述图的颜色颜色等；
 如果图中有划线，画圈等，要注意这可能是表达的重点信息。
             """
+    default_merge_prompt = '''
+下面是同一会话按时间顺序分段得到的多段总结，请将它们合并为一份完整的总结：
+    *   用户特定指令:{custom_prompt} ，如果不为无，优先遵循用户特定指令；
+    *   跨段落的同一话题请合并，时间范围取最早到最晚；
+    *   保留各段中的关键信息（关键字/数据/观点/结论等），不要过度压缩；
+    *   格式：
+        1️⃣[Topic][热度(用1-5个🔥表示)]
+        • 时间：月-日 时:分 - -日 时:分(不显示年)
+        • 参与者：
+        • 内容：
+        • 结论：
+    ………
+'''
+    default_pyramid_prompt = '''
+下面是同一会话较早时间段的分级总结（[周]/[日]/[时] 表示总结覆盖的时间段，按时间顺序排列），以及最近一段时间的原始聊天记录，请将它们合并为一份完整的总结：
+    *   用户特定指令:{custom_prompt} ，如果不为无，优先遵循用户特定指令；
+    *   较早时间段只有总结，请保留其中的关键信息，不要因为篇幅较短而忽略；
+    *   最近的聊天记录格式：开头的发言人表给出了发言人代号与昵称的对应关系，总结中请使用昵称；## 开头的行是日期，每条消息格式为“时:分 发言人代号: 内容”；
+    *   跨时间段的同一话题请合并，时间范围取最早到最晚；
+    *   格式：
+        1️⃣[Topic][热度(用1-5个🔥表示)]
+        • 时间：月-日 时:分 - -日 时:分(不显示年)
+        • 参与者：
+        • 内容：
+        • 结论：
+    ………
+'''
     #新增的多模态LLM配置
     multimodal_llm_api_base = ""
     multimodal_llm_model = ""
@@ -106,11 +147,22 @@ class Summary(Plugin):
             self.summary_max_tokens = self.config.get("summary_max_tokens", 8000)
             self.input_max_tokens_limit = self.config.get("input_max_tokens_limit", 160000)
             self.chunk_max_tokens = self.config.get("chunk_max_tokens", 16000)
+            self.max_summary_chunks = self.config.get("max_summary_chunks", 10)
             
             # 初始化数据库
             curdir = os.path.dirname(__file__)
-            db_path = os.path.join(curdir, "chat.db")
-            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            db_path = self.config.get("db_path") or os.path.join(curdir, "chat.db")
+            self.store = ChatStore(db_path)
+            self.segmenter = TopicSegmenter.from_config(self.config)
+            # 超过 blob_min_length 个字符的消息内容压缩后按哈希去重存放，最近读取的内容缓存在内存中
+            self.blob_min_length = self.config.get("blob_min_length", BLOB_MIN_LENGTH)
+            self.blob_cache = BlobCache(max_entries=self.config.get("blob_cache_entries", 256))
+            # 活跃会话最近消息的内存缓存，最近时间窗口的总结不必查询数据库
+            self.tail_cache = None
+            if self.config.get("tail_cache_enabled", True):
+                self.tail_cache = TailCache(max_messages=self.config.get("tail_cache_messages", 500),
+                                            max_minutes=self.config.get("tail_cache_minutes", 180),
+                                            max_total_messages=self.config.get("tail_cache_max_total", 50000))
             self._init_database()
 
             # 初始化线程池
@@ -118,6 +170,50 @@ class Summary(Plugin):
             self.pending_tasks = 0
             self.max_pending_tasks = 20
 
+            # 图片预处理进程池（首次使用时创建），与等待网络的线程池分开，避免 CPU 密集任务争用 GIL
+            self.image_process_workers = self.config.get("image_process_workers", 2)
+            self.image_process_timeout = self.config.get("image_process_timeout", 30)
+            self.image_process_pool = None
+            # 按需识图：图片先记录为待识别，总结时再识别实际用到的图片
+            self.lazy_image_recognition = self.config.get("lazy_image_recognition", False)
+            self.lazy_image_timeout = self.config.get("lazy_image_timeout", 60)
+            self._image_lock = threading.Lock()
+            # 正在识别的待识别图片 {(会话, 消息ID): future}
+            self._pending_image_futures = {}
+            self.image_stats = {"processed": 0, "failed": 0, "queue_depth": 0, "max_queue_depth": 0,
+                                "queue_ms": 0.0, "preprocess_ms": 0.0, "recognize_ms": 0.0}
+
+            # 总结请求的合并与准入控制
+            self.summary_flight = SingleFlight()
+            self.summary_admission = AdmissionController(global_limit=self.config.get("summary_global_concurrency", 3),
+                                                         session_limit=self.config.get("summary_session_concurrency", 1),
+                                                         max_queue=self.config.get("summary_queue_size", 10))
+            self.summary_queue_timeout = self.config.get("summary_queue_timeout", 300)
+            # 分段总结时并行生成各段，完成一段（按时间顺序）就先发送一段
+            self.summary_chunk_executor = ThreadPoolExecutor(max_workers=self.config.get("summary_chunk_concurrency", 3))
+            self.progressive_summary = self.config.get("progressive_summary", True)
+            # 后台任务模式：$总结 立即返回任务ID，总结完成后推送结果，也可用 $总结结果 查询
+            self.summary_jobs = None
+            if self.config.get("summary_async_jobs", False):
+                self.summary_jobs = SummaryJobManager(self.store, workers=self.config.get("summary_job_workers", 3),
+                                                      retention_days=self.config.get("summary_job_retention_days", 7))
+                self.summary_jobs.recover()
+            # 多粒度总结：较长的时间范围使用已保存的小时/天/周总结 + 最近的原始消息
+            self.summary_pyramid_enabled = self.config.get("summary_pyramid", False)
+            self.pyramid_min_hours = self.config.get("pyramid_min_hours", 24)
+            self.pyramid = SummaryPyramid(self.store, self._summarize_period_records, self._merge_period_summaries,
+                                          direct_tokens=self.chunk_max_tokens,
+                                          workers=self.config.get("summary_chunk_concurrency", 3),
+                                          max_new_periods=self.config.get("pyramid_max_new_periods", 8))
+
+            # 录制线上事件用于离线回放（可选）
+            record_path = self.config.get("replay_record_path")
+            if record_path and not os.path.isabs(record_path):
+                record_path = os.path.join(curdir, record_path)
+            self.recorder = None
+            if record_path:
+                self.recorder = EventRecorder(record_path, trigger_prefix=self.config.get('plugin_trigger_prefix', "$"))
+
             # 注册事件处理器
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             self.handlers[Event.ON_RECEIVE_MESSAGE] = self.on_receive_message
@@ -129,22 +225,23 @@ class Summary(Plugin):
 
     def _init_database(self):
         """初始化数据库架构"""
-        c = self.conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS chat_records
-                    (sessionid TEXT, msgid INTEGER, user TEXT, content TEXT, type TEXT, timestamp INTEGER, is_triggered INTEGER,
-                    PRIMARY KEY (sessionid, msgid))''')
-        
-        # 检查 is_triggered 列是否存在
-        c = c.execute("PRAGMA table_info(chat_records);")
-        column_exists = False
-        for column in c.fetchall():
-            if column[1] == 'is_triggered':
-                column_exists = True
-                break
-        if not column_exists:
-            self.conn.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0;")
-            self.conn.execute("UPDATE chat_records SET is_triggered = 0;")
-        self.conn.commit()
+        with self.store.write() as conn:
+            init_schema(conn)
+
+            # 旧数据库升级：为没有话题段的记录补齐话题段
+            if conn.execute("SELECT 1 FROM chat_records WHERE segment_id IS NULL LIMIT 1").fetchone():
+                logger.info("[Summary] 正在为已有聊天记录划分话题段")
+                session_ids = [row[0] for row in conn.execute(
+                    "SELECT DISTINCT sessionid FROM chat_records WHERE segment_id IS NULL").fetchall()]
+                self.segmenter.rebuild(conn, session_ids)
+
+            # 上次运行中正在识别的图片没有写回结果，重新标记为待识别
+            conn.execute("UPDATE image_pending SET status='pending' WHERE status='running'")
+
+            # 清理被覆盖写入的记录残留的 blob
+            removed = gc_blobs(conn)
+            if removed:
+                logger.info(f"[Summary] 已清理 {removed} 个未被引用的消息内容 blob")
 
     def _load_config(self):
         """从 config.json 加载配置"""
@@ -200,48 +297,78 @@ class Summary(Plugin):
             'max_tokens': self.summary_max_tokens #修改变量名
         }
 
-    def _chat_completion(self, content, e_context, custom_prompt=None, prompt_type="summary"):
+    def _build_prompt(self, content, custom_prompt=None, prompt_type="summary"):
         """
-        准备总结提示词并传递给下一个插件处理
-        
-        :param content: 需要总结的聊天内容
-        :param e_context: 事件上下文
+        构造完整的提示词
+
+        :param content: 需要处理的内容
         :param custom_prompt: 可选的自定义 prompt
-        :param prompt_type: 定义使用哪一个类型的prompt，可选值 summary，image
-        :return: None，由下一个插件处理
+        :param prompt_type: 定义使用哪一个类型的prompt，可选值 summary，image，merge，pyramid
+        :return: 完整的提示词
+        """
+        # 使用默认 prompt
+        if prompt_type == "summary":
+            prompt_to_use = self.default_summary_prompt
+        elif prompt_type == "image":
+            prompt_to_use = self.default_image_prompt
+        elif prompt_type == "merge":
+            prompt_to_use = self.default_merge_prompt
+        elif prompt_type == "pyramid":
+            prompt_to_use = self.default_pyramid_prompt
+        else:
+            prompt_to_use = self.default_summary_prompt  # 默认选择 summary 类型
+
+        # 固定的规则部分放在最前面且每次完全相同，便于模型服务商的前缀缓存命中；
+        # {custom_prompt} 只替换为固定的引用说明，实际的自定义指令放在规则之后
+        prompt_to_use = prompt_to_use.replace("{custom_prompt}", "见下方【用户特定指令】")
+
+        # 使用 custom_prompt，如果 custom_prompt 为空，则替换为 "无"
+        replacement_prompt = custom_prompt if custom_prompt else "无"
+        
+        content_title = {"merge": "各段总结", "pyramid": "分级总结与最近的聊天记录"}.get(prompt_type, "聊天记录")
+        
+        # 构造完整的提示词：固定规则 -> 用户特定指令 -> 待处理内容
+        return f"{prompt_to_use}\n\n【用户特定指令】\n{replacement_prompt}\n\n【{content_title}】\n'''{content}'''"
+
+    def _bot_completion(self, prompt, context):
+        """
+        直接调用当前配置的 bot 生成回复
+
+        使用独立的 session_id，避免总结内容混入用户的对话上下文
+
+        :param context: 触发总结的消息上下文
+        :return: bot 回复的文本
         """
+        session_id = f"summary_{uuid.uuid4().hex}"
+        context = Context(ContextType.TEXT, prompt, dict(context.kwargs))
+        context['session_id'] = session_id
         try:
-            # 使用默认 prompt
-            if prompt_type == "summary":
-                prompt_to_use = self.default_summary_prompt
-            elif prompt_type == "image":
-                prompt_to_use = self.default_image_prompt
-            else:
-                prompt_to_use = self.default_summary_prompt  # 默认选择 summary 类型
+            reply = Bridge().fetch_reply_content(prompt, context)
+        finally:
+            self._clear_bot_session(session_id)
+        if not reply or reply.type != ReplyType.TEXT or not reply.content:
+            raise Exception(f"bot 返回异常: {reply.content if reply else None}")
+        return reply.content
+
+    @staticmethod
+    def _clear_bot_session(session_id):
+        """
+        清除 bot 为一次性 session_id 保存的会话
 
-            # 使用 custom_prompt，如果 custom_prompt 为空，则替换为 "无"
-            replacement_prompt = custom_prompt if custom_prompt else "无"
-            prompt_to_use = prompt_to_use.replace("{custom_prompt}", replacement_prompt)
-            
-            # 构造完整的提示词
-            full_prompt = f"{prompt_to_use}\n\n'''{content}'''"
-            
-            # 修改 context 内容，传递给下一个插件处理
-            e_context['context'].type = ContextType.TEXT
-            e_context['context'].content = full_prompt
-            
-            # 继续传递给下一个插件处理
-            e_context.action = EventAction.CONTINUE
-            logger.debug(f"[Summary] 传递内容给下一个插件处理: length={len(full_prompt)}")
-            return
-            
+        SessionManager 未设置 expires_in_seconds 时会话永不过期，不清除的话每次总结的完整提示词都会留在内存中
+        """
+        try:
+            sessions = getattr(Bridge().get_bot("chat"), "sessions", None)
+            if sessions is not None:
+                sessions.clear_session(session_id)
         except Exception as e:
-            logger.error(f"[Summary] 总结生成失败: {e}")
-            return f"总结失败：{str(e)}"
+            logger.warning(f"[Summary] 清除总结会话失败: {e}")
 
-    def _multimodal_completion(self, api_key, image_path, text_prompt, model="GLM-4V-Flash", detail="low"):
+    def _multimodal_completion(self, api_key, image_path, text_prompt, model="GLM-4V-Flash", detail="low", base64_image=None):
         """
         调用多模态 API 进行图片理解和文本生成。
+
+        传入 base64_image 时直接使用预处理后的图片，否则读取 image_path 原图
         """
 
         api_url = f"{self.multimodal_llm_api_base}/chat/completions" # 从配置项读取并拼接 URL
@@ -253,8 +380,11 @@ class Summary(Plugin):
 
         try:
             # 1. 读取图片并进行 base64 编码
-            with open(image_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
+            if base64_image:
+                encoded_string = base64_image
+            else:
+                with open(image_path, "rb") as image_file:
+                    encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
             image_url_data = f"data:image/jpeg;base64,{encoded_string}"
 
 
@@ -319,46 +449,136 @@ class Summary(Plugin):
             logger.error(f"[Summary] 错误类型: {type(e)}")
             return None
 
+    def _get_image_process_pool(self):
+        """获取图片预处理进程池，不存在则创建"""
+        with self._image_lock:
+            if self.image_process_pool is None:
+                # 使用 spawn 启动子进程，避免在多线程进程中 fork 导致子进程死锁
+                self.image_process_pool = ProcessPoolExecutor(max_workers=self.image_process_workers,
+                                                              mp_context=multiprocessing.get_context("spawn"))
+            return self.image_process_pool
+
     def _resize_and_encode_image(self, image_path):
-        """将图片调整大小并编码为 base64"""
+        """
+        在进程池中将图片调整大小并编码为 JPEG，返回 base64 字符串
+
+        调用线程只负责等待结果和 base64 编码，解码/缩放/重新编码都在子进程中完成
+        """
+        with self._image_lock:
+            self.image_stats["queue_depth"] += 1
+            self.image_stats["max_queue_depth"] = max(self.image_stats["max_queue_depth"], self.image_stats["queue_depth"])
+            queue_depth = self.image_stats["queue_depth"]
+        submit_time = time.perf_counter()
         try:
-            img = Image.open(image_path)
-            
-            # 将图片转换为 RGB 模式，去除 alpha 通道
-            if img.mode == 'RGBA':
-                img = img.convert('RGB')
-
-            max_size = (2048, 2048)
-            img.thumbnail(max_size)
-
-            # 检查图片大小，如果超过 1M 就尝试降低质量
-            if os.path.getsize(image_path) > 1 * 1024 * 1024:
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG", quality=80)  # 降低质量
-                base64_str = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                if len(base64_str) * 3 / 4 / 1024 / 1024 > 1: #评估base64后的图片大小是否超过1M，是的话直接放弃
-                   return None
-                return base64_str
-            else:
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG")
-                return base64.b64encode(buffer.getvalue()).decode('utf-8')
+            future = self._get_image_process_pool().submit(resize_and_encode_image, image_path)
+            jpeg_bytes, error, preprocess_seconds = future.result(timeout=self.image_process_timeout)
         except Exception as e:
             logger.error(f"[Summary] 图片处理失败: {e}")
             return None
+        finally:
+            with self._image_lock:
+                self.image_stats["queue_depth"] -= 1
+
+        total_ms = (time.perf_counter() - submit_time) * 1000
+        preprocess_ms = preprocess_seconds * 1000
+        with self._image_lock:
+            self.image_stats["queue_ms"] += total_ms - preprocess_ms
+            self.image_stats["preprocess_ms"] += preprocess_ms
+        logger.debug(f"[Summary] 图片预处理: 排队 {total_ms - preprocess_ms:.0f}ms, 处理 {preprocess_ms:.0f}ms, 队列深度 {queue_depth}")
+
+        if error:
+            logger.error(f"[Summary] 图片处理失败: {error}")
+            return None
+        return base64.b64encode(jpeg_bytes).decode('utf-8')
+
+    def _insert_record(self, session_id, msg_id, user, content, msg_type, timestamp, is_triggered = 0, quoted_user=None):
+        """
+        将记录插入到数据库（通过串行化的写连接），并在同一事务中更新小时统计、话题段和最近消息缓存
 
-    def _insert_record(self, session_id, msg_id, user, content, msg_type, timestamp, is_triggered = 0):
-        """将记录插入到数据库"""
-        c = self.conn.cursor()
+        :param quoted_user: 引用消息中被引用人的昵称，用于话题段的回复链判断
+        """
         logger.debug("[Summary] 插入记录: {} {} {} {} {} {} {}" .format(session_id, msg_id, user, content, msg_type, timestamp, is_triggered))
-        c.execute("INSERT OR REPLACE INTO chat_records VALUES (?,?,?,?,?,?,?)", (session_id, msg_id, user, content, msg_type, timestamp, is_triggered))
-        self.conn.commit()
+        try:
+            with self.store.write() as conn:
+                self._write_record(conn, session_id, msg_id, user, content, msg_type, timestamp, is_triggered, quoted_user)
+        except Exception:
+            # 写入失败时缓存可能已包含未提交的记录
+            if self.tail_cache:
+                self.tail_cache.invalidate(session_id)
+            raise
+
+    def _write_record(self, conn, session_id, msg_id, user, content, msg_type, timestamp, is_triggered, quoted_user):
+        """在写事务中写入一条记录，同时更新小时统计、话题段和最近消息缓存"""
+        if self.tail_cache and not self.tail_cache.has(session_id):
+            # 会话第一次写入时从空缓存开始，只覆盖当前最新记录之后的消息，避免在写锁内加载历史记录
+            latest = conn.execute("SELECT MAX(timestamp) FROM chat_records WHERE sessionid=?", (session_id,)).fetchone()[0]
+            self.tail_cache.start(session_id, -1 if latest is None else latest)
+        # 同一条消息可能被覆盖写入（如图片识别结果），先扣除旧记录的统计，并沿用原来的话题段
+        old = conn.execute("SELECT user, content, timestamp, is_triggered, segment_id, content_ref FROM chat_records WHERE sessionid=? AND msgid=?",
+                           (session_id, msg_id)).fetchone()
+        if old and old[4] is not None:
+            segment_id = old[4]
+        else:
+            segment_id = self.segmenter.assign(conn, session_id, user, content, timestamp, quoted_user)
+        # 长内容存入 chat_blobs，记录中只保存引用
+        stored_content, content_ref = store_content(conn, content, self.blob_min_length)
+        c = conn.execute("INSERT OR REPLACE INTO chat_records (sessionid, msgid, user, content, type, timestamp, is_triggered, segment_id, content_ref) "
+                         "VALUES (?,?,?,?,?,?,?,?,?)",
+                         (session_id, msg_id, user, stored_content, msg_type, timestamp, is_triggered, segment_id, content_ref))
+        if old:
+            old_content = self.blob_cache.get(conn, old[5]) if old[5] else old[1]
+            update_hourly_stats(conn, session_id, old[0], old_content, old[2], old[3], sign=-1)
+        update_hourly_stats(conn, session_id, user, content, timestamp, is_triggered)
+        # 覆盖写入或补录到已结束的小时，已保存的周期总结不再准确
+        if old or timestamp < period_start("hour", time.time()):
+            invalidate_periods(conn, session_id, timestamp)
+        if self.tail_cache:
+            # 读回刚写入的行，缓存中的记录与数据库查询结果（经过列类型转换）完全一致
+            record = conn.execute("SELECT * FROM chat_records WHERE rowid=?", (c.lastrowid,)).fetchone()
+            self.tail_cache.put(session_id, record[:3] + (content,) + record[4:])
+
+    def _get_hourly_stats(self, session_id, start_timestamp=0):
+        """获取会话从 start_timestamp 所在小时起的小时统计，按时间正序"""
+        start_hour = int(start_timestamp) // 3600 * 3600
+        return self.store.query(
+            "SELECT hour, msg_count, token_sum, speaker_count, trigger_count FROM chat_hourly_stats "
+            "WHERE sessionid=? AND hour>=? AND msg_count>0 ORDER BY hour", (session_id, start_hour))
+
+    def _plan_summary(self, session_id, start_timestamp=0, limit=9999):
+        """
+        根据小时统计预估总结窗口的规模，决定单次总结还是分段总结
+
+        :return: dict(msg_count, tokens, mode, chunks)
+        """
+        msg_count = 0
+        tokens = 0
+        # 从最新的小时往前累加，直到达到条数限制
+        for hour, count, token_sum, _, _ in reversed(self._get_hourly_stats(session_id, start_timestamp)):
+            if msg_count + count > limit:
+                # 最后一个小时只取一部分，按比例估算
+                remain = limit - msg_count
+                tokens += token_sum * remain // count
+                msg_count = limit
+                break
+            msg_count += count
+            tokens += token_sum
+
+        if tokens <= self.input_max_tokens_limit:
+            mode, chunks = "single", 1
+        else:
+            mode = "chunked"
+            chunks = min(-(-tokens // self.chunk_max_tokens), self.max_summary_chunks)
+        return {"msg_count": msg_count, "tokens": tokens, "mode": mode, "chunks": chunks}
     
     def _get_records(self, session_id, start_timestamp=0, limit=9999):
-        """从数据库获取记录"""
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM chat_records WHERE sessionid=? and timestamp>? ORDER BY timestamp DESC LIMIT ?", (session_id, start_timestamp, limit))
-        return c.fetchall()
+        """获取记录：优先从最近消息缓存读取，缓存不能覆盖时从数据库读取（使用当前线程的只读连接，在一致性快照中读取）"""
+        if self.tail_cache:
+            records = self.tail_cache.get(session_id, start_timestamp, limit)
+            if records is not None:
+                return records
+        with self.store.read() as conn:
+            c = conn.execute("SELECT * FROM chat_records WHERE sessionid=? and timestamp>? ORDER BY timestamp DESC LIMIT ?", (session_id, start_timestamp, limit))
+            return self.blob_cache.resolve(conn, c.fetchall())
 
     def _normalize_name(self, name):
         """
@@ -452,6 +672,8 @@ class Summary(Plugin):
     def on_receive_message(self, e_context: EventContext):
         """处理接收到的消息"""
         context = e_context['context']
+        if self.recorder:
+            self.recorder.record("receive", context)
         cmsg : ChatMessage = e_context['context']['msg']
         
         # 检查消息内容是否需要过滤
@@ -471,59 +693,12 @@ class Summary(Plugin):
                     return
         """
 
-        # 新增：使用正则表达式匹配特殊格式消息
-        special_msg_pattern = re.compile(r'「.*?:.*?」-+\s*(.*)')
-        match = special_msg_pattern.fullmatch(content)
-        if match and match.group(1):
-            content = match.group(1).strip()
-            logger.debug(f"[Summary] 检测到特殊格式消息，已提取实际内容: {content}")
-
-        # 如果是表情消息（XML 格式），替换为“表情”
-        if content.startswith("<msg><emoji") and content.endswith("</msg>"):
-            content = "表情"
-            logger.debug(f"[Summary] 检测到表情消息，已替换为“表情”")
-        
-        # 如果是语音消息（XML 格式），替换为“语音”
-        elif content.startswith("<msg><voicemsg") and content.endswith("</msg>"):
-            content = "语音"
-            logger.debug(f"[Summary] 检测到语音消息，已替换为“语音”")
-        
-        # 如果是合并聊天记录消息（XML 格式），提取 <des> 标签中的内容
-        elif content.startswith("<?xml version=\"1.0\"?>") and "<title>群聊的聊天记录</title>" in content:
-            try:
-                # 解析 XML
-                root = ET.fromstring(content)
-                des_tag = root.find(".//des")  # 查找 <des> 标签
-                if des_tag is not None and des_tag.text:
-                    # 提取 <des> 标签中的内容
-                    content = des_tag.text.strip()
-                    logger.debug(f"[Summary] 检测到合并聊天记录，已提取 <des> 内容: {content}")
-                else:
-                    content = "聊天记录（无内容）"
-                    logger.debug(f"[Summary] 检测到合并聊天记录，但 <des> 标签为空")
-            except ET.ParseError as e:
-                logger.error(f"[Summary] XML 解析失败: {e}")
-                content = "聊天记录（解析失败）"
-
-        # 如果是文件消息（XML 格式），提取 <title> 标签中的内容
-        elif content.startswith("<?xml version=\"1.0\"?>") and "<title>" in content:
-            try:
-                # 解析 XML
-                root = ET.fromstring(content)
-                title_tag = root.find(".//title")  # 查找 <des> 标签
-                if title_tag is not None and title_tag.text:
-                    # 提取 <title> 标签中的内容
-                    content = title_tag.text.strip()
-                    logger.debug(f"[Summary] 检测到文件，已提取 <title> 内容: {content}")
-                else:
-                    content = "文件（无标题）"
-                    logger.debug(f"[Summary] 检测到文件，但 <title> 标签为空")
-            except ET.ParseError as e:
-                logger.error(f"[Summary] XML 解析失败: {e}")
-                content = "文件（解析失败）"
+        # 去除引用、XML 等冗余信息
+        quoted_user = extract_quoted_user(content)
+        content = normalize_content(content)
         
         # 过滤短命令消息
-        if (('#' in content or '$' in content) and len(content) < 50):
+        if is_command_message(content):
             logger.debug(f"[Summary] 消息被过滤: {content}")
             return
         
@@ -559,15 +734,80 @@ class Summary(Plugin):
             if match_prefix is not None:
                 is_triggered = True
 
-        self._insert_record(session_id, cmsg.msg_id, username, content, str(context.type), cmsg.create_time, int(is_triggered))
+        self._insert_record(session_id, cmsg.msg_id, username, content, str(context.type), cmsg.create_time, int(is_triggered), quoted_user)
         logger.debug("[Summary] {}:{} ({})" .format(username, content, session_id))
         
         # 处理图片消息
         if context.type == ContextType.IMAGE and self.multimodal_llm_api_base and self.multimodal_llm_model and self.multimodal_llm_api_key:
             context.get("msg").prepare()
             image_path = context.content  # 假设 context.content 是图片本地路径
-            self._process_image_async(session_id, cmsg.msg_id, username, image_path, cmsg.create_time)
+            if self.lazy_image_recognition:
+                self._add_pending_image(session_id, cmsg.msg_id, username, image_path, cmsg.create_time)
+            else:
+                self._process_image_async(session_id, cmsg.msg_id, username, image_path, cmsg.create_time)
+
+
+    def _add_pending_image(self, session_id, msg_id, username, image_path, create_time):
+        """记录待识别的图片，等到总结实际用到时再识别"""
+        with self.store.write() as conn:
+            conn.execute("INSERT OR REPLACE INTO image_pending VALUES (?,?,?,?,?,?)",
+                         (session_id, msg_id, username, image_path, create_time, "pending"))
+        logger.debug(f"[Summary] 图片已记录为待识别 - 会话ID: {session_id}, 消息ID: {msg_id}")
 
+    def _recognize_pending_images(self, session_id, start_timestamp=0, limit=9999):
+        """
+        并行识别总结窗口内所有待识别的图片，识别结果写回数据库
+
+        待识别的图片在写事务中标记为 running 后才提交识别，同一张图片不会被并发的总结重复识别；
+        其他总结正在识别的图片会一起等待。每张图片识别结束时（即使已超过本次等待时间）由回调删除
+        待识别记录或标记为 failed
+
+        :return: 本次等待时间内识别成功的图片数量
+        """
+        with self.store.write() as conn:
+            rows = conn.execute(
+                "SELECT msgid, user, image_path, timestamp FROM image_pending "
+                "WHERE sessionid=? AND timestamp>? AND status='pending' ORDER BY timestamp DESC LIMIT ?",
+                (session_id, start_timestamp, limit)).fetchall()
+            conn.executemany("UPDATE image_pending SET status='running' WHERE sessionid=? AND msgid=?",
+                             [(session_id, row[0]) for row in rows])
+
+        with self._image_lock:
+            futures = {key: future for key, future in self._pending_image_futures.items() if key[0] == session_id}
+            for msg_id, user, image_path, timestamp in rows:
+                future = self.executor.submit(self._process_image, session_id, msg_id, user, image_path, timestamp)
+                futures[(session_id, msg_id)] = self._pending_image_futures[(session_id, msg_id)] = future
+        for msg_id, _, _, _ in rows:
+            future = futures[(session_id, msg_id)]
+            future.add_done_callback(lambda f, msg_id=msg_id: self._finish_pending_image(session_id, msg_id, f))
+        if not futures:
+            return 0
+
+        logger.info(f"[Summary] 总结前识别待处理图片: 会话={session_id}, 新提交={len(rows)}, 等待中={len(futures)}")
+        done, not_done = wait(futures.values(), timeout=self.lazy_image_timeout)
+        if not_done:
+            logger.warning(f"[Summary] {len(not_done)} 张图片识别超时，本次总结不包含其描述，识别完成后会写入数据库")
+        return sum(1 for future in done if not future.exception() and future.result() is True)
+
+    def _finish_pending_image(self, session_id, msg_id, future):
+        """待识别图片的识别结束回调：成功的删除待识别记录，失败的标记为 failed 不再重试"""
+        try:
+            result = future.result()
+        except Exception as e:
+            result = str(e)
+        recognized = result is True
+        with self._image_lock:
+            self._pending_image_futures.pop((session_id, msg_id), None)
+            self.image_stats["processed" if recognized else "failed"] += 1
+        try:
+            with self.store.write() as conn:
+                if recognized:
+                    conn.execute("DELETE FROM image_pending WHERE sessionid=? AND msgid=?", (session_id, msg_id))
+                else:
+                    conn.execute("UPDATE image_pending SET status='failed' WHERE sessionid=? AND msgid=?",
+                                 (session_id, msg_id))
+        except Exception as e:
+            logger.error(f"[Summary] 更新待识别图片状态失败: {e}")
 
     def _process_image_async(self, session_id, msg_id, username, image_path, create_time):
         """使用线程池异步处理图片消息"""
@@ -607,7 +847,11 @@ class Summary(Plugin):
                 logger.error(f"[Summary] {error_msg}")
                 return error_msg
 
-            text_content = self._multimodal_completion(self.multimodal_llm_api_key, image_path, self.default_image_prompt, model=self.multimodal_llm_model)
+            recognize_start = time.perf_counter()
+            text_content = self._multimodal_completion(self.multimodal_llm_api_key, image_path, self.default_image_prompt,
+                                                       model=self.multimodal_llm_model, base64_image=base64_image)
+            with self._image_lock:
+                self.image_stats["recognize_ms"] += (time.perf_counter() - recognize_start) * 1000
 
             if text_content is None:
                     error_msg = "识图失败：多模态LLM API返回为空"
@@ -631,6 +875,8 @@ class Summary(Plugin):
     def _handle_image_result(self, future):
         try:
             result = future.result()
+            with self._image_lock:
+                self.image_stats["processed" if result is True else "failed"] += 1
             if result is None:  # 检查 result 是否为 None
                 logger.error("[Summary] 异步图片处理结果为空")
                 print("[Summary] 异步图片处理结果为空")  # 添加打印到控制台的逻辑
@@ -645,84 +891,137 @@ class Summary(Plugin):
             logger.error(f"[Summary] 异步处理结果错误：{e}")
             print(f"[Summary] 异步处理结果错误：{e}")  # 添加打印到控制台的逻辑
 
+    @staticmethod
+    def _record_segment(record):
+        """记录的话题段ID，旧记录没有话题段时返回 None"""
+        return record[7] if len(record) > 7 else None
+
+    def _group_by_segment(self, records):
+        """
+        将倒序（最新的在前）的记录按话题段分组
+
+        :return: 按时间正序排列的 [(segment_id, [record, ...]), ...]
+        """
+        groups = []
+        for record in reversed(records):
+            segment_id = self._record_segment(record)
+            if groups and groups[-1][0] == segment_id:
+                groups[-1][1].append(record)
+            else:
+                groups.append((segment_id, [record]))
+        return groups
+
     def _check_tokens(self, records, max_tokens=None):  # 添加默认值
-        """准备用于总结的聊天内容"""
-        messages = []
-        total_length = 0
+        """准备用于总结的聊天内容（紧凑格式，按预先划分的话题段分隔）"""
+        selected = []
+        speakers = set()
+        total_length = len(SPEAKER_HEADER)
         # 修改变量名
-        max_input_chars = self.input_max_tokens_limit * 4  # 粗略估计：1个 token 约等于 4 个字符
+        max_input_chars = (max_tokens or self.input_max_tokens_limit) * 4  # 粗略估计：1个 token 约等于 4 个字符
         
         # 记录已经是倒序的（最新的在前），直接处理
         for record in records:
-            username = record[2] or ""  # 处理空用户名
-            content = record[3] or ""   # 处理空内容
-            timestamp = record[5]
-            is_triggered = record[6]
-            
-            # 将时间戳转换为可读格式
-            time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
-            
-            if record[4] in [str(ContextType.IMAGE),str(ContextType.VOICE)]:
-                content = f"[{record[4]}]"
-            
-            sentence = f'[{time_str}] {username}: "{content}"'
-            if is_triggered:
-                sentence += " <T>"
+            length = estimate_line_length(record)
+            if record[2] not in speakers:
+                length += estimate_speaker_length(record[2])
                 
             # 检查添加此记录后是否会超出限制
-            if total_length + len(sentence) + 2 > max_input_chars:  # 2 是换行符的长度
+            if total_length + length > max_input_chars:
                 logger.info(f"[Summary] 输入长度限制已达到 {total_length} 个字符")
                 break
                 
-            messages.append(sentence)
-            total_length += len(sentence) + 2
+            selected.append(record)
+            speakers.add(record[2])
+            total_length += length
 
-        # 将消息按时间顺序拼接（从早到晚）
-        query = "\n\n".join(messages[::-1])
-        return query
+        if not selected:
+            return ""
+        # 按时间顺序（从早到晚）按话题段分组后渲染
+        return render_transcript(self._group_by_segment(selected))
 
-    def _split_messages_to_summarys(self, records, custom_prompt="", max_summarys=10):
-        """将消息分割成块并总结每个块"""
-        summarys = []
-        count = 0
+    def _split_messages_to_chunks(self, records, max_chunks=None):
+        """
+        将记录按话题段切分为不超过 chunk_max_tokens 的块，尽量不把一个话题拆到两个块中
 
-        while len(records) > 0 and len(summarys) < max_summarys:
-            # 修改变量名
-            query = self._check_tokens(records) # 移除 max_tokens
-            if not query:
-                break
+        :param records: 倒序（最新的在前）的记录
+        :param max_chunks: 最多保留的块数，超出时丢弃最早的块
+        :return: 按时间正序排列的块列表，每个块是按话题段分组的记录 [(segment_id, [record, ...]), ...]
+        """
+        max_chunk_chars = self.chunk_max_tokens * 4
+        chunks = []
+        current = []
+        current_length = 0
+        for segment_id, segment_records in self._group_by_segment(records):
+            segment_length = sum(estimate_line_length(record) for record in segment_records)
+            if current and current_length + segment_length > max_chunk_chars:
+                chunks.append(current)
+                current = []
+                current_length = 0
+            if segment_length <= max_chunk_chars:
+                current.append((segment_id, segment_records))
+                current_length += segment_length
+                continue
+            # 单个话题段超过块大小（旧数据没有话题段时），退化为按字符数切分
+            part = []
+            for record in segment_records:
+                length = estimate_line_length(record)
+                if part and current_length + length > max_chunk_chars:
+                    current.append((segment_id, part))
+                    chunks.append(current)
+                    current = []
+                    current_length = 0
+                    part = []
+                part.append(record)
+                current_length += length
+            current.append((segment_id, part))
+        if current:
+            chunks.append(current)
+
+        if max_chunks and len(chunks) > max_chunks:
+            logger.info(f"[Summary] 分段数 {len(chunks)} 超过上限 {max_chunks}，丢弃最早的 {len(chunks) - max_chunks} 段")
+            chunks = chunks[-max_chunks:]
+        return chunks
+
+    @staticmethod
+    def _chunk_time_range(chunk):
+        """块内消息的时间范围，如 05-01 09:15 ~ 05-01 11:40"""
+        first = chunk[0][1][0][5]
+        last = chunk[-1][1][-1][5]
+        return f"{time.strftime('%m-%d %H:%M', time.localtime(first))} ~ {time.strftime('%m-%d %H:%M', time.localtime(last))}"
+
+    def _split_messages_to_summarys(self, records, context, custom_prompt="", max_summarys=10, on_summary=None):
+        """
+        将消息分割成块并并行总结每个块，返回按时间顺序排列的各段总结
+
+        :param on_summary: 每段总结完成时的回调，参数为 (段序号, 总段数, 时间范围, 总结)；
+                           按时间顺序调用，较早的段完成之前，已完成的较晚的段会先等待
+        """
+        chunks = self._split_messages_to_chunks(records, max_summarys)
+
+        def summarize(chunk):
+            prompt = self._build_prompt(render_transcript(chunk), custom_prompt, prompt_type="summary")
+            return self._bot_completion(prompt, context)
 
+        futures = {self.summary_chunk_executor.submit(summarize, chunk): i for i, chunk in enumerate(chunks)}
+        results = {}
+        next_index = 0
+        for future in as_completed(futures):
+            i = futures[future]
             try:
-                result = self._chat_completion(query, custom_prompt, prompt_type="summary")
-                summarys.append(result)
-                count += 1
+                results[i] = future.result()
+                logger.debug(f"[Summary] 第 {i + 1}/{len(chunks)} 段总结完成")
             except Exception as e:
-                logger.error(f"[Summary] 总结失败: {e}")
-                break
-
-            # 修改变量名，使用字符长度判断
-            query_chars_len = len(self._check_tokens(records))
-            if query_chars_len > (self.chunk_max_tokens*4):
-               records_temp = self._check_tokens(records)[:(self.chunk_max_tokens*4)] # 截取字符
-               
-               #找到截取字符对应的记录条数
-               record_count = 0
-               temp_records = []
-               for record in records:
-                  record_content = f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record[5]))}] {record[2] or ""}: "{record[3] or ""}"'
-                  if record[6]:
-                        record_content += " <T>"
-                  
-                  if len("\n\n".join(temp_records+[record_content])) <= (self.chunk_max_tokens*4):
-                    temp_records.append(record_content)
-                    record_count = record_count + 1
-                  else:
-                      break
-               
-               records = records[record_count:]
-            else:
-                break
-        return summarys
+                logger.error(f"[Summary] 第 {i + 1}/{len(chunks)} 段总结失败: {e}")
+                results[i] = None
+            # 按时间顺序交付已经连续完成的段
+            while next_index in results:
+                if results[next_index] is not None and on_summary:
+                    try:
+                        on_summary(next_index, len(chunks), self._chunk_time_range(chunks[next_index]), results[next_index])
+                    except Exception as e:
+                        logger.warning(f"[Summary] 发送第 {next_index + 1} 段总结失败: {e}")
+                next_index += 1
+        return [results[i] for i in range(len(chunks)) if results[i] is not None]
 
     def _parse_summary_command(self, command_parts):
         """
@@ -776,9 +1075,8 @@ class Summary(Plugin):
 
     def _get_all_session_ids(self):
         """获取数据库中所有不同的会话ID"""
-        c = self.conn.cursor()
-        c.execute("SELECT DISTINCT sessionid FROM chat_records")
-        return [row[0] for row in c.fetchall()]
+        rows = self.store.query("SELECT DISTINCT sessionid FROM chat_records")
+        return [row[0] for row in rows]
 
     def _fuzzy_match_sessions(self, target_pattern, is_group=True):
         """
@@ -805,6 +1103,8 @@ class Summary(Plugin):
     def on_handle_context(self, e_context: EventContext):
         """处理上下文，进行总结"""
         context = e_context['context']
+        if self.recorder:
+            self.recorder.record("handle", context)
         content = context.content
         msg = context['msg']
         
@@ -847,28 +1147,8 @@ class Summary(Plugin):
                 # 重新解析剩余参数
                 start_time, limit, custom_prompt, _, _ = self._parse_summary_command(new_params)
                 
-                records = self._get_records(session_id, start_time, limit)
-                
-                if not records:
-                    reply = Reply(ReplyType.ERROR, f"没有找到指定会话的聊天记录")
-                    e_context["reply"] = reply
-                    e_context.action = EventAction.BREAK_PASS
-                    return
-                
-                # 准备聊天记录内容
-                query = self._check_tokens(records)
-                if not query:
-                    reply = Reply(ReplyType.ERROR, "聊天记录为空")
-                    e_context["reply"] = reply
-                    e_context.action = EventAction.BREAK_PASS
-                    return
-
-                # 发送处理中的提示
-                processing_reply = Reply(ReplyType.TEXT, "🎉正在为您生成总结，请稍候...")
-                e_context["channel"].send(processing_reply, e_context["context"])
-                
-                # 调用总结功能并传递给下一个插件
-                return self._chat_completion(query, e_context, custom_prompt, "summary")
+                return self._summarize_session(e_context, session_id, start_time, limit, custom_prompt,
+                                               "没有找到指定会话的聊天记录")
             
             # 检查是否是普通总结命令
             elif command == "总结":
@@ -933,28 +1213,357 @@ class Summary(Plugin):
                         # 单聊：使用用户昵称作为session_id
                         session_id = msg.other_user_nickname or msg.from_user_id
 
-                records = self._get_records(session_id, start_time, limit)
-                
-                if not records:
-                    reply = Reply(ReplyType.ERROR, f"没有找到{'指定会话的' if target_session else ''}聊天记录")
-                    e_context["reply"] = reply
-                    e_context.action = EventAction.BREAK_PASS
-                    return
-                
-                # 准备聊天记录内容
-                query = self._check_tokens(records)
-                if not query:
-                    reply = Reply(ReplyType.ERROR, "聊天记录为空")
-                    e_context["reply"] = reply
-                    e_context.action = EventAction.BREAK_PASS
-                    return
+                return self._summarize_session(e_context, session_id, start_time, limit, custom_prompt,
+                                               f"没有找到{'指定会话的' if target_session else ''}聊天记录")
+
+            # 处理"总结结果"命令：查询后台总结任务
+            elif command == "总结结果":
+                if not self.summary_jobs:
+                    reply = Reply(ReplyType.ERROR, "未开启后台总结任务模式")
+                elif len(clist) > 1:
+                    job = self.summary_jobs.get(clist[1], requester=self._requester_id(context))
+                    if job is None:
+                        reply = Reply(ReplyType.ERROR, f"没有找到总结任务 {clist[1]}")
+                    elif job["status"] == FAILED:
+                        reply = Reply(ReplyType.ERROR, self._format_job(job))
+                    else:
+                        reply = Reply(ReplyType.TEXT, self._format_job(job))
+                else:
+                    jobs = self.summary_jobs.recent(self._requester_id(context))
+                    if not jobs:
+                        reply = Reply(ReplyType.TEXT, "没有总结任务")
+                    else:
+                        status_text = {QUEUED: "排队中", RUNNING: "生成中", DONE: "已完成", FAILED: "失败"}
+                        lines = [f"{job_id} {time.strftime('%m-%d %H:%M', time.localtime(created_at))} "
+                                 f"{sessionid} {status_text.get(status, status)}"
+                                 for job_id, sessionid, status, created_at in jobs]
+                        reply = Reply(ReplyType.TEXT, "最近的总结任务：\n" + "\n".join(lines) +
+                                      f"\n\n发送 {trigger_prefix}总结结果 [任务ID] 查看结果")
+                e_context["reply"] = reply
+                e_context.action = EventAction.BREAK_PASS
+                return
+
+            # 处理"总结统计"命令
+            elif command == "总结统计":
+                msg = e_context['context']['msg']
+                session_id = msg.other_user_nickname or msg.from_user_id
+                days = 7
+                if len(clist) > 1 and clist[1].startswith('-') and clist[1].endswith('d') and clist[1][1:-1].isdigit():
+                    days = max(1, min(int(clist[1][1:-1]), 30))
+                reply = Reply(ReplyType.TEXT, self._format_activity_stats(session_id, days))
+                e_context["reply"] = reply
+                e_context.action = EventAction.BREAK_PASS
+                return
+
+            # 处理"总结状态"命令：插件全局的运行状态，涉及所有会话，仅管理员在私聊中使用
+            elif command == "总结状态":
+                config_password = self.config.get('summary_password', '')
+                if e_context['context'].get("isgroup", False):
+                    reply = Reply(ReplyType.ERROR, "运行状态仅支持私聊查询")
+                elif not config_password:
+                    reply = Reply(ReplyType.ERROR, "管理员未设置访问密码，无法查询运行状态")
+                elif len(clist) < 2 or clist[1] != config_password:
+                    reply = Reply(ReplyType.ERROR, "访问密码错误")
+                else:
+                    reply = Reply(ReplyType.TEXT, self._format_runtime_stats())
+                e_context["reply"] = reply
+                e_context.action = EventAction.BREAK_PASS
+                return
+
+    def _summarize_session(self, e_context, session_id, start_time, limit, custom_prompt, not_found_text):
+        """
+        获取会话记录并生成总结，结果直接回复；开启后台任务模式时提交任务并立即回复任务ID
+        """
+        if self.summary_jobs:
+            return self._submit_summary_job(e_context, session_id, start_time, limit, custom_prompt, not_found_text)
+
+        channel = e_context["channel"]
+        context = e_context["context"]
+        try:
+            result, shared = self._coalesced_summary(session_id, start_time, limit, custom_prompt, channel, context,
+                                                     not_found_text)
+        except SummaryError as e:
+            reply = Reply(ReplyType.ERROR, str(e))
+        except Exception as e:
+            logger.error(f"[Summary] 总结生成失败: {e}")
+            reply = Reply(ReplyType.ERROR, f"总结失败：{str(e)}")
+        else:
+            if shared:
+                logger.info(f"[Summary] 复用进行中的总结结果: 会话={session_id}")
+            reply = Reply(ReplyType.TEXT, result)
+        e_context["reply"] = reply
+        e_context.action = EventAction.BREAK_PASS
+
+    def _coalesced_summary(self, session_id, start_time, limit, custom_prompt, channel, context, not_found_text):
+        """
+        生成总结，进度提示通过 channel 发送
+
+        相同会话、时间范围、条数和自定义指令的并发请求只计算一次，所有请求共享同一个结果
+
+        :return: (总结文本, 是否复用了其他请求的结果)
+        """
+        def notify(text):
+            channel.send(Reply(ReplyType.TEXT, text), context)
+
+        # 相对时间（如 -2h）在不同请求间会相差几秒，按分钟对齐后作为合并的依据
+        key = (session_id, start_time // 60, limit, custom_prompt)
+        return self.summary_flight.do(
+            key,
+            lambda: self._run_summary(session_id, start_time, limit, custom_prompt, context, notify, not_found_text),
+            on_join=lambda: notify("👥相同的总结正在生成中，完成后会一并回复您，请稍候..."))
+
+    @staticmethod
+    def _requester_id(context):
+        """发起请求的会话（群名或用户昵称），用于限制任务结果的查询范围"""
+        msg = context["msg"]
+        return msg.other_user_nickname or msg.from_user_id
+
+    def _submit_summary_job(self, e_context, session_id, start_time, limit, custom_prompt, not_found_text):
+        """提交后台总结任务，立即回复任务ID，完成后通过 channel 推送结果"""
+        channel = e_context["channel"]
+        context = e_context["context"]
+        trigger_prefix = self.config.get('plugin_trigger_prefix', "$")
+
+        def run():
+            result, _ = self._coalesced_summary(session_id, start_time, limit, custom_prompt, channel, context,
+                                                not_found_text)
+            return result
+
+        def on_finish(job):
+            if job["status"] == DONE:
+                reply = Reply(ReplyType.TEXT, job["result"])
+            else:
+                reply = Reply(ReplyType.ERROR, f"总结任务 {job['job_id']} 失败：{job['error']}")
+            channel.send(reply, context)
+
+        params = {"start_time": start_time, "limit": limit, "custom_prompt": custom_prompt}
+        job_id = self.summary_jobs.submit(session_id, self._requester_id(context), params, run, on_finish)
+        logger.info(f"[Summary] 已提交总结任务 {job_id}: 会话={session_id}, {params}")
+        e_context["reply"] = Reply(ReplyType.TEXT, f"📋总结任务已提交，任务ID：{job_id}\n"
+                                                   f"完成后会自动发送结果，也可以发送 {trigger_prefix}总结结果 {job_id} 查询")
+        e_context.action = EventAction.BREAK_PASS
+
+    def _format_job(self, job):
+        """任务查询结果的回复文本"""
+        created = time.strftime("%m-%d %H:%M", time.localtime(job["created_at"]))
+        if job["status"] == DONE:
+            return job["result"]
+        if job["status"] == FAILED:
+            return f"总结任务 {job['job_id']}（{created} 提交）失败：{job['error']}"
+        state = "排队中" if job["status"] == QUEUED else "正在生成"
+        return f"⏳总结任务 {job['job_id']}（{created} 提交）{state}，完成后会自动发送结果"
+
+    def _run_summary(self, session_id, start_time, limit, custom_prompt, context, notify, not_found_text):
+        """
+        在准入控制下生成总结
+
+        根据小时统计预估窗口规模：规模在 input_max_tokens_limit 以内时单次总结，
+        否则先分段总结，再将各段总结合并
+
+        :param notify: 发送进度提示的回调
+        :return: 总结文本，失败时抛出 SummaryError
+        """
+        admitted = self.summary_admission.acquire(
+            session_id,
+            on_queued=lambda position: notify(f"⏳当前总结请求较多，您排在第{position}位，请稍候..."),
+            timeout=self.summary_queue_timeout)
+        if not admitted:
+            raise SummaryError("当前总结请求过多，请稍后再试")
+        try:
+            plan = self._plan_summary(session_id, start_time, limit)
+            logger.info(f"[Summary] 总结计划: 会话={session_id}, {plan}")
 
+            # 先识别窗口内待识别的图片，分级总结和原始记录中才不会出现 [IMAGE] 占位
+            if self.lazy_image_recognition:
+                self._recognize_pending_images(session_id, start_time, limit)
+
+            if self._use_pyramid(plan, start_time, limit):
+                return self._pyramid_summary(session_id, start_time, custom_prompt, context, notify)
+
+            records = self._get_records(session_id, start_time, limit)
+            if not records:
+                raise SummaryError(not_found_text)
+
+            if plan["mode"] == "chunked":
                 # 发送处理中的提示
-                processing_reply = Reply(ReplyType.TEXT, "🎉正在为您生成总结，请稍候...")
-                e_context["channel"].send(processing_reply, e_context["context"])
-                
-                # 调用总结功能并传递给下一个插件
-                return self._chat_completion(query, e_context, custom_prompt, "summary")
+                notify(f"🎉正在为您生成总结，请稍候...\n"
+                       f"约 {plan['msg_count']} 条消息、{plan['tokens']} tokens，将分 {plan['chunks']} 段总结"
+                       + ("，每段完成后先发送，最后发送合并后的总结" if self.progressive_summary else ""))
+
+                on_summary = None
+                if self.progressive_summary:
+                    # 每段完成后先发送，不必等全部完成
+                    def on_summary(i, total, time_range, summary):
+                        if total > 1:
+                            notify(f"📝第{i + 1}/{total}段（{time_range}）\n{summary}")
+
+                summarys = self._split_messages_to_summarys(records, context, custom_prompt, self.max_summary_chunks,
+                                                            on_summary)
+                if not summarys:
+                    raise SummaryError("分段总结失败，请稍后再试")
+
+                # 合并各段总结，作为最终的完整总结回复
+                merged = "\n\n".join(f"【第{i + 1}段】\n{summary}" for i, summary in enumerate(summarys))
+                return self._bot_completion(self._build_prompt(merged, custom_prompt, "merge"), context)
+
+            # 准备聊天记录内容
+            query = self._check_tokens(records)
+            if not query:
+                raise SummaryError("聊天记录为空")
+
+            # 发送处理中的提示
+            notify("🎉正在为您生成总结，请稍候...")
+            return self._bot_completion(self._build_prompt(query, custom_prompt, "summary"), context)
+        finally:
+            self.summary_admission.release(session_id)
+
+    def _get_records_between(self, session_id, start_timestamp, end_timestamp):
+        """获取 [start_timestamp, end_timestamp) 内的记录，按时间倒序"""
+        with self.store.read() as conn:
+            c = conn.execute("SELECT * FROM chat_records WHERE sessionid=? AND timestamp>=? AND timestamp<? ORDER BY timestamp DESC",
+                             (session_id, start_timestamp, end_timestamp))
+            return self.blob_cache.resolve(conn, c.fetchall())
+
+    def _summarize_period_records(self, session_id, start_timestamp, end_timestamp, context):
+        """总结一个周期内的原始消息（多粒度总结的最底层），不使用自定义指令以便复用"""
+        records = self._get_records_between(session_id, start_timestamp, end_timestamp)
+        if not records:
+            return None
+        if sum(estimate_line_length(record) for record in records) <= self.chunk_max_tokens * 4:
+            query = render_transcript(self._group_by_segment(records))
+            return self._bot_completion(self._build_prompt(query, None, "summary"), context)
+        summarys = self._split_messages_to_summarys(records, context)
+        if len(summarys) <= 1:
+            return summarys[0] if summarys else None
+        merged = "\n\n".join(f"【第{i + 1}段】\n{summary}" for i, summary in enumerate(summarys))
+        return self._bot_completion(self._build_prompt(merged, None, "merge"), context)
+
+    def _merge_period_summaries(self, parts, context):
+        """将下一级周期的总结合并为上一级周期的总结"""
+        merged = "\n\n".join(f"{format_period(level, start)}\n{summary}" for level, start, summary in parts)
+        return self._bot_completion(self._build_prompt(merged, None, "merge"), context)
+
+    def _use_pyramid(self, plan, start_time, limit):
+        """是否使用多粒度总结：时间范围足够长、消息量超过单次总结上限，且没有指定条数"""
+        return (self.summary_pyramid_enabled and plan["mode"] == "chunked" and start_time > 0 and limit >= 9999
+                and time.time() - start_time >= self.pyramid_min_hours * 3600)
+
+    def _pyramid_summary(self, session_id, start_time, custom_prompt, context, notify):
+        """
+        长时间范围的总结：最近的消息（不超过一半的输入预算）使用原始记录，
+        更早的部分用尽可能粗的已结束周期（周/日/小时）的总结覆盖，没有消息的小时直接跳过
+
+        :return: 总结文本
+        """
+        hourly = {hour: (count, tokens) for hour, count, tokens, _, _ in self._get_hourly_stats(session_id, start_time)}
+        if not hourly:
+            raise SummaryError("没有找到聊天记录")
+        raw_budget = self.input_max_tokens_limit // 2
+
+        # 从最新的小时往前，找到原始消息部分的起点（整点）
+        raw_start = period_start("hour", time.time())
+        raw_tokens = 0
+        for hour in sorted(hourly, reverse=True):
+            if raw_tokens + hourly[hour][1] > raw_budget:
+                break
+            raw_tokens += hourly[hour][1]
+            raw_start = hour
+        pyramid_start = period_start("hour", start_time)
+        periods = [(level, start) for level, start, _ in tile(pyramid_start, raw_start)]
+        notify("🎉正在为您生成总结，请稍候...\n时间范围较长，较早的部分使用按小时/天/周的分级总结（首次生成需要较长时间）")
+
+        summaries, skipped = self.pyramid.collect(session_id, periods, hourly, context)
+        parts = [f"{format_period(level, start)}\n{summary}" for level, start, summary in summaries]
+
+        # 分级总结超出剩余预算时，丢弃最早的部分
+        budget_chars = (self.input_max_tokens_limit - raw_tokens) * 4
+        total_chars = sum(len(part) for part in parts)
+        while parts and total_chars > budget_chars:
+            total_chars -= len(parts.pop(0))
+            logger.info("[Summary] 分级总结超出输入上限，丢弃最早的一段")
+
+        content = "【较早时间段的分级总结】\n" + ("\n\n".join(parts) if parts else "无")
+        if skipped:
+            # 未生成的周期留给之后的请求，这里说明有省略，避免模型把缺失当作没有讨论
+            content += f"\n（另有更早的 {skipped} 个时间段的分级总结尚未生成，本次省略）"
+            logger.info(f"[Summary] 本次未生成 {skipped} 个周期的分级总结: 会话={session_id}")
+        records = self._get_records(session_id, max(start_time, raw_start - 1))
+        if records:
+            content += "\n\n【最近的聊天记录】\n" + self._check_tokens(records, raw_budget)
+        logger.info(f"[Summary] 多粒度总结: 会话={session_id}, 分级总结 {len(parts)} 段, 最近消息 {len(records)} 条")
+        return self._bot_completion(self._build_prompt(content, custom_prompt, "pyramid"), context)
+
+    def _format_image_stats(self):
+        """图片处理流水线的统计信息（全局），没有处理过图片时返回空字符串"""
+        with self._image_lock:
+            stats = dict(self.image_stats)
+        count = stats["processed"] + stats["failed"]
+        if not count:
+            return ""
+        return (f"图片识别：成功 {stats['processed']} / 失败 {stats['failed']}，"
+                f"平均排队 {stats['queue_ms'] / count:.0f}ms、预处理 {stats['preprocess_ms'] / count:.0f}ms、"
+                f"识图 {stats['recognize_ms'] / count:.0f}ms，"
+                f"预处理队列 {stats['queue_depth']}（峰值 {stats['max_queue_depth']}）")
+
+    def _format_activity_stats(self, session_id, days=7):
+        """
+        根据小时统计生成活跃度热力图（不扫描原始聊天记录）
+
+        :param session_id: 会话ID
+        :param days: 统计最近多少天
+        :return: 统计文本
+        """
+        now = int(time.time())
+        # 以本地时间的天为单位对齐
+        today_start = int(time.mktime(time.strptime(time.strftime("%Y-%m-%d", time.localtime(now)), "%Y-%m-%d")))
+        start = today_start - (days - 1) * 86400
+        rows = self._get_hourly_stats(session_id, start)
+        if not rows:
+            return f"最近{days}天没有找到聊天记录"
+
+        levels = " ▁▂▃▄▅▆▇█"
+        grid = {}
+        hour_of_day = [0] * 24
+        total_msgs = total_tokens = total_triggers = 0
+        for hour, count, tokens, _, triggers in rows:
+            local = time.localtime(hour)
+            grid.setdefault(time.strftime("%m-%d", local), [0] * 24)[local.tm_hour] += count
+            hour_of_day[local.tm_hour] += count
+            total_msgs += count
+            total_tokens += tokens
+            total_triggers += triggers
+        peak = max(max(counts) for counts in grid.values())
+
+        lines = [f"📊 {session_id} 最近{days}天活跃度", f"{'日期':<4} |0{' ' * 21}23| 条数"]
+        for i in range(days):
+            day = time.strftime("%m-%d", time.localtime(start + i * 86400))
+            counts = grid.get(day, [0] * 24)
+            bar = "".join(levels[0 if c == 0 else max(1, c * (len(levels) - 1) // peak)] for c in counts)
+            lines.append(f"{day} |{bar}| {sum(counts)}")
+
+        speakers = self.store.query(
+            "SELECT COUNT(DISTINCT user) FROM chat_hourly_speakers WHERE sessionid=? AND hour>=?",
+            (session_id, start))[0][0]
+        busiest_hour = hour_of_day.index(max(hour_of_day))
+        lines.append("")
+        lines.append(f"消息数：{total_msgs}（约 {total_tokens} tokens）")
+        lines.append(f"发言人数：{speakers}")
+        lines.append(f"触发机器人：{total_triggers} 次")
+        lines.append(f"最活跃时段：{busiest_hour}:00-{busiest_hour + 1}:00")
+        return "\n".join(lines)
+
+    def _format_runtime_stats(self):
+        """插件全局的运行状态（所有会话），供管理员通过 $总结状态 查询"""
+        lines = ["⚙️ 总结插件运行状态"]
+        lines.append(self._format_image_stats() or "图片识别：暂无记录")
+        if self.tail_cache:
+            cached_sessions, cached_messages, hits, misses = self.tail_cache.stats()
+            lines.append(f"最近消息缓存：{cached_sessions} 个会话 / {cached_messages} 条，命中 {hits} 次、未命中 {misses} 次")
+        running, queued = self.summary_admission.status()
+        lines.append(f"总结请求：生成中 {running}，排队 {queued}，合并后的不同请求 {self.summary_flight.inflight_count()}")
+        if self.summary_jobs:
+            lines.append(f"后台总结任务：排队和运行中 {self.summary_jobs.active_count()} 个")
+        return "\n".join(lines)
 
     def get_help_text(self, verbose = False, **kwargs):
         help_text = "聊天记录总结插件。\n"
@@ -971,7 +1580,17 @@ class Summary(Plugin):
    - {trigger_prefix}总结 g群名称 密码 100 (总结指定群最近100条消息)
    - {trigger_prefix}总结 u用户名 密码 -2h (总结指定用户最近2小时消息)
 
-3. 白名单设置:
+3. 活跃度统计:
+   - {trigger_prefix}总结统计 (当前会话最近7天按小时的活跃度)
+   - {trigger_prefix}总结统计 -3d (最近3天)
+   - {trigger_prefix}总结状态 密码 (私聊，插件全局的运行状态，需要密码)
+
+4. 后台任务（需开启 summary_async_jobs）:
+   - {trigger_prefix}总结 会立即返回任务ID，完成后自动发送结果
+   - {trigger_prefix}总结结果 (查看最近的任务)
+   - {trigger_prefix}总结结果 任务ID (查看任务状态或结果)
+
+5. 白名单设置:
    - 默认启用模糊匹配，只要配置中的名称部分包含实际会话名称或实际会话名称包含配置名称即可匹配成功
    - 例如：白名单中有"测试群"，则"测试群123"和"123测试群"都会被记录
    - 可在配置文件中设置 "use_fuzzy_matching": false 来禁用模糊匹配，改用精确匹配
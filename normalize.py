@@ -0,0 +1,84 @@
+# encoding:utf-8
+
+import re
+import xml.etree.ElementTree as ET
+
+from common.log import logger
+
+# 引用消息格式：「昵称:被引用内容」----- 实际内容
+SPECIAL_MSG_PATTERN = re.compile(r'「(.*?):.*?」-+\s*(.*)')
+
+
+def normalize_content(content):
+    """
+    去除消息中的冗余信息（引用消息、表情/语音/合并聊天记录/文件等 XML 消息），只保留文字内容
+
+    实时接收消息和批量导入历史记录共用此逻辑，保证入库格式一致
+
+    :param content: 原始消息内容
+    :return: 处理后的消息内容
+    """
+    # 新增：使用正则表达式匹配特殊格式消息
+    match = SPECIAL_MSG_PATTERN.fullmatch(content)
+    if match and match.group(2):
+        content = match.group(2).strip()
+        logger.debug(f"[Summary] 检测到特殊格式消息，已提取实际内容: {content}")
+
+    # 如果是表情消息（XML 格式），替换为“表情”
+    if content.startswith("<msg><emoji") and content.endswith("</msg>"):
+        content = "表情"
+        logger.debug(f"[Summary] 检测到表情消息，已替换为“表情”")
+    
+    # 如果是语音消息（XML 格式），替换为“语音”
+    elif content.startswith("<msg><voicemsg") and content.endswith("</msg>"):
+        content = "语音"
+        logger.debug(f"[Summary] 检测到语音消息，已替换为“语音”")
+    
+    # 如果是合并聊天记录消息（XML 格式），提取 <des> 标签中的内容
+    elif content.startswith("<?xml version=\"1.0\"?>") and "<title>群聊的聊天记录</title>" in content:
+        try:
+            # 解析 XML
+            root = ET.fromstring(content)
+            des_tag = root.find(".//des")  # 查找 <des> 标签
+            if des_tag is not None and des_tag.text:
+                # 提取 <des> 标签中的内容
+                content = des_tag.text.strip()
+                logger.debug(f"[Summary] 检测到合并聊天记录，已提取 <des> 内容: {content}")
+            else:
+                content = "聊天记录（无内容）"
+                logger.debug(f"[Summary] 检测到合并聊天记录，但 <des> 标签为空")
+        except ET.ParseError as e:
+            logger.error(f"[Summary] XML 解析失败: {e}")
+            content = "聊天记录（解析失败）"
+
+    # 如果是文件消息（XML 格式），提取 <title> 标签中的内容
+    elif content.startswith("<?xml version=\"1.0\"?>") and "<title>" in content:
+        try:
+            # 解析 XML
+            root = ET.fromstring(content)
+            title_tag = root.find(".//title")  # 查找 <des> 标签
+            if title_tag is not None and title_tag.text:
+                # 提取 <title> 标签中的内容
+                content = title_tag.text.strip()
+                logger.debug(f"[Summary] 检测到文件，已提取 <title> 内容: {content}")
+            else:
+                content = "文件（无标题）"
+                logger.debug(f"[Summary] 检测到文件，但 <title> 标签为空")
+        except ET.ParseError as e:
+            logger.error(f"[Summary] XML 解析失败: {e}")
+            content = "文件（解析失败）"
+
+    return content
+
+
+def extract_quoted_user(content):
+    """提取引用消息中被引用人的昵称，不是引用消息时返回 None"""
+    match = SPECIAL_MSG_PATTERN.fullmatch(content)
+    if match and match.group(2):
+        return match.group(1).strip() or None
+    return None
+
+
+def is_command_message(content):
+    """判断是否是需要过滤的短命令消息（<50字符且包含$或#）"""
+    return ('#' in content or '$' in content) and len(content) < 50
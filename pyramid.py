@@ -0,0 +1,180 @@
+# encoding:utf-8
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from common.log import logger
+
+# 从粗到细的总结粒度
+LEVELS = ("week", "day", "hour")
+LEVEL_NAMES = {"week": "周", "day": "日", "hour": "时"}
+
+
+def period_start(level, timestamp):
+    """timestamp 所在周期的起点（日、周按本地时间对齐，周从周一开始）"""
+    if level == "hour":
+        return int(timestamp) // 3600 * 3600
+    day = datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+    if level == "week":
+        day -= timedelta(days=day.weekday())
+    return int(day.timestamp())
+
+
+def period_end(level, start):
+    """以 start 为起点的周期的终点（不含）"""
+    if level == "hour":
+        return start + 3600
+    day = datetime.fromtimestamp(start) + timedelta(days=7 if level == "week" else 1)
+    return int(day.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+
+def tile(start, end):
+    """
+    用尽可能粗的完整周期覆盖 [start, end)
+
+    :param start: 整点时间戳
+    :param end: 整点时间戳
+    :return: 按时间正序排列的 [(level, period_start, period_end), ...]
+    """
+    periods = []
+    t = start
+    while t < end:
+        for level in LEVELS:
+            if period_start(level, t) == t and period_end(level, t) <= end:
+                periods.append((level, t, period_end(level, t)))
+                t = period_end(level, t)
+                break
+    return periods
+
+
+def format_period(level, start):
+    """周期的可读描述，如 [周 05-06 ~ 05-12]、[日 05-13]、[时 05-14 09:00]"""
+    if level == "week":
+        last_day = period_end(level, start) - 1
+        return f"[周 {time.strftime('%m-%d', time.localtime(start))} ~ {time.strftime('%m-%d', time.localtime(last_day))}]"
+    if level == "day":
+        return f"[日 {time.strftime('%m-%d', time.localtime(start))}]"
+    return f"[时 {time.strftime('%m-%d %H:00', time.localtime(start))}]"
+
+
+def invalidate_periods(conn, session_id, timestamp):
+    """在写事务中删除包含 timestamp 的已保存周期总结（消息被覆盖写入或补录到已结束的周期时调用）"""
+    conn.execute("DELETE FROM summary_pyramid WHERE sessionid=? AND period_start<=? AND period_end>?",
+                 (session_id, timestamp, timestamp))
+
+
+class SummaryPyramid:
+    """
+    多粒度总结：已结束的小时、天、周的总结按需生成并保存在 summary_pyramid 表中
+
+    - 周期内的消息量不超过 direct_tokens 时，直接总结原始消息
+    - 否则由下一级（周 -> 日 -> 小时）的总结合并得到
+    - 没有消息的周期（根据小时统计判断）直接跳过，不查询原始消息
+    - 保存时记录周期内的消息数，之后消息数发生变化（补录、导入）时重新生成；消息内容被覆盖（如图片识别结果）时
+      由 invalidate_periods 删除包含它的周期总结
+    - 一次请求中缺失的周期在独立的线程池中并行生成，最多生成 max_new_periods 个，其余留给之后的请求
+    """
+
+    def __init__(self, store, summarize_records, merge_summaries, direct_tokens=16000, workers=3, max_new_periods=8):
+        """
+        :param summarize_records: 总结原始消息的函数，参数为 (会话, 起点, 终点, 上下文)，返回总结文本
+        :param merge_summaries: 合并多段总结的函数，参数为 ([(level, 起点, 总结), ...], 上下文)，返回总结文本
+        :param workers: 并行生成周期总结的线程数；summarize_records 内部会使用分段总结的线程池，
+                        因此这里使用独立的线程池，避免互相等待
+        :param max_new_periods: 每次请求最多生成的周期数，0 表示不限制
+        """
+        self.store = store
+        self.summarize_records = summarize_records
+        self.merge_summaries = merge_summaries
+        self.direct_tokens = direct_tokens
+        self.max_new_periods = max_new_periods
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="summary_pyramid")
+
+    @staticmethod
+    def _hour_totals(hourly, start, end):
+        """根据小时统计 {hour: (msg_count, tokens)} 计算 [start, end) 内的消息数和 token 数"""
+        msg_count = tokens = 0
+        for hour, (count, token_sum) in hourly.items():
+            if start <= hour < end:
+                msg_count += count
+                tokens += token_sum
+        return msg_count, tokens
+
+    def _load(self, session_id, level, start):
+        rows = self.store.query("SELECT msg_count, summary FROM summary_pyramid WHERE sessionid=? AND level=? AND period_start=?",
+                                (session_id, level, start))
+        return rows[0] if rows else None
+
+    def _save(self, session_id, level, start, end, msg_count, summary):
+        self.store.execute("INSERT OR REPLACE INTO summary_pyramid (sessionid, level, period_start, period_end, msg_count, summary, created_at) "
+                           "VALUES (?,?,?,?,?,?,?)",
+                           (session_id, level, start, end, msg_count, summary, int(time.time())))
+
+    def summary(self, session_id, level, start, hourly, context):
+        """
+        获取已结束周期的总结，不存在或已过期时生成
+
+        :param hourly: 会话的小时统计 {hour: (msg_count, tokens)}，需覆盖该周期
+        :param context: 触发总结的消息上下文，调用 bot 时使用
+        :return: 总结文本，周期内没有消息时返回 None
+        """
+        end = period_end(level, start)
+        msg_count, tokens = self._hour_totals(hourly, start, end)
+        if not msg_count:
+            return None
+        stored = self._load(session_id, level, start)
+        if stored and stored[0] == msg_count:
+            return stored[1]
+
+        if level == "hour" or tokens <= self.direct_tokens:
+            text = self.summarize_records(session_id, start, end, context)
+        else:
+            child = "day" if level == "week" else "hour"
+            parts = []
+            child_start = start
+            while child_start < end:
+                child_summary = self.summary(session_id, child, child_start, hourly, context)
+                if child_summary:
+                    parts.append((child, child_start, child_summary))
+                child_start = period_end(child, child_start)
+            text = self.merge_summaries(parts, context) if len(parts) > 1 else (parts[0][2] if parts else None)
+        if text:
+            logger.debug(f"[Summary] 已生成{LEVEL_NAMES[level]}总结: 会话={session_id}, {format_period(level, start)}")
+            self._save(session_id, level, start, end, msg_count, text)
+        return text
+
+    def collect(self, session_id, periods, hourly, context):
+        """
+        获取一组已结束周期的总结：已保存的直接复用，缺失或过期的并行生成，
+        超出 max_new_periods 时优先生成较新的周期，较早的本次省略
+
+        :param periods: 按时间正序排列的 [(level, 起点), ...]
+        :param hourly: 会话的小时统计 {hour: (msg_count, tokens)}，需覆盖全部周期
+        :return: ([(level, 起点, 总结), ...] 按时间正序, 省略的周期数)
+        """
+        texts = {}
+        missing = []
+        for level, start in periods:
+            msg_count, _ = self._hour_totals(hourly, start, period_end(level, start))
+            if not msg_count:
+                continue
+            stored = self._load(session_id, level, start)
+            if stored and stored[0] == msg_count:
+                texts[(level, start)] = stored[1]
+            else:
+                missing.append((level, start))
+
+        skipped = 0
+        if self.max_new_periods and len(missing) > self.max_new_periods:
+            skipped = len(missing) - self.max_new_periods
+            missing = missing[skipped:]
+        futures = {period: self._executor.submit(self.summary, session_id, period[0], period[1], hourly, context)
+                   for period in missing}
+        for period, future in futures.items():
+            try:
+                texts[period] = future.result()
+            except Exception as e:
+                logger.error(f"[Summary] 生成{LEVEL_NAMES[period[0]]}总结失败: 会话={session_id}, {format_period(*period)}: {e}")
+                skipped += 1
+        return [(level, start, texts[(level, start)]) for level, start in periods if texts.get((level, start))], skipped
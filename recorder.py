@@ -0,0 +1,163 @@
+# encoding:utf-8
+
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from common.log import logger
+
+# 录制文件中的字段使用短名称以减小体积
+MSG_FIELDS = {
+    "msg_id": "i",
+    "create_time": "ts",
+    "other_user_nickname": "g",
+    "from_user_id": "f",
+    "actual_user_nickname": "n",
+    "actual_user_id": "a",
+    "is_at": "at",
+}
+# 需要脱敏的身份字段
+_IDENTITY_FIELDS = ("other_user_nickname", "from_user_id", "actual_user_nickname", "actual_user_id")
+# @ 提及时可能出现的昵称（机器人在群里的名称也会被 @）
+_MENTION_FIELDS = ("actual_user_nickname", "other_user_nickname", "to_user_nickname", "self_display_name")
+_QUOTE_PATTERN = re.compile(r'「(.*?):')
+
+
+class EventRecorder:
+    """
+    将插件收到的事件脱敏后写入 gzip 压缩的 JSONL 文件，供 replay 模块离线回放
+
+    会话名、昵称和用户ID替换为带随机盐的哈希别名（无法反推原名），盐保存在录制文件旁的 .salt 文件中，
+    重启后别名保持不变；消息内容中出现的用户ID前缀、引用和 @ 的昵称同样替换，总结命令中的 g/u 目标替换为别名、
+    密码替换为 ***，其余内容原样保留以还原真实的消息构成
+    """
+
+    def __init__(self, path, trigger_prefix="$", flush_every=100, flush_seconds=10):
+        self.path = path
+        self.trigger_prefix = trigger_prefix
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self._aliases = {}
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._salt = self._load_salt(path + ".salt")
+        # 进程正常退出时写出缓冲中的事件
+        atexit.register(self.close)
+
+    @staticmethod
+    def _load_salt(salt_path):
+        """读取录制文件对应的盐，不存在时生成并保存（仅所有者可读写）"""
+        try:
+            with open(salt_path, "rb") as f:
+                salt = f.read()
+            if len(salt) >= 16:
+                return salt
+        except FileNotFoundError:
+            pass
+        salt = os.urandom(16)
+        fd = os.open(salt_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(salt)
+        return salt
+
+    def _alias(self, value):
+        if not value:
+            return value
+        alias = self._aliases.get(value)
+        if alias is None:
+            alias = "u_" + hashlib.sha1(self._salt + value.encode("utf-8")).hexdigest()[:10]
+            self._aliases[value] = alias
+        return alias
+
+    def _anonymize_content(self, content, msg):
+        if not isinstance(content, str):
+            return content
+        actual_user_id = getattr(msg, "actual_user_id", None)
+        if actual_user_id and content.startswith(f"{actual_user_id}:"):
+            content = f"{self._alias(actual_user_id)}:{self._anonymize_command(content[len(actual_user_id) + 1:])}"
+        else:
+            content = self._anonymize_command(content)
+        content = _QUOTE_PATTERN.sub(lambda m: f"「{self._alias(m.group(1))}:", content)
+        return self._anonymize_mentions(content, msg)
+
+    def _anonymize_mentions(self, content, msg):
+        """@昵称 替换为 @别名：先匹配消息中已知的昵称（可能包含空格），其余取 @ 到下一个空白（含 \u2005）之间的部分"""
+        if "@" not in content:
+            return content
+        names = sorted({name for name in (getattr(msg, field, None) for field in _MENTION_FIELDS) if isinstance(name, str) and name},
+                       key=len, reverse=True)
+        pattern = r"(?:(?<=\s)|^)@(" + "".join(re.escape(name) + "|" for name in names) + r"\S+)"
+        return re.sub(pattern, lambda m: "@" + self._alias(m.group(1)), content)
+
+    def _anonymize_command(self, content):
+        """总结命令中的 g/u 目标替换为别名（保留前缀，回放时仍能解析），紧随其后的密码替换为 ***"""
+        parts = content.split()
+        if not parts or not parts[0].startswith(self.trigger_prefix + "总结"):
+            return content
+        if parts[0] == self.trigger_prefix + "总结状态":
+            return " ".join(parts[:1] + ["***"] * (len(parts) - 1))
+        # 与 _parse_summary_command 的解析规则保持一致
+        i = 1
+        while i < len(parts):
+            part = parts[i]
+            if part.startswith('g') or part.startswith('u'):
+                parts[i] = part[0] + self._alias(part[1:])
+                if i + 1 < len(parts):
+                    parts[i + 1] = "***"
+                    i += 1
+            i += 1
+        return " ".join(parts)
+
+    def record(self, event, context):
+        """
+        记录一个事件
+
+        :param event: 事件名，receive 或 handle
+        :param context: 消息上下文
+        """
+        try:
+            msg = context.get("msg")
+            with self._lock:
+                fields = {}
+                for name, key in MSG_FIELDS.items():
+                    value = getattr(msg, name, None)
+                    fields[key] = self._alias(value) if name in _IDENTITY_FIELDS else value
+                line = json.dumps({
+                    "e": event,
+                    "t": time.time(),
+                    "ct": context.type.name,
+                    "c": self._anonymize_content(context.content, msg),
+                    "grp": bool(context.get("isgroup", False)),
+                    "m": fields,
+                }, ensure_ascii=False)
+                self._pending.append(line)
+                if len(self._pending) >= self.flush_every or time.time() - self._last_flush >= self.flush_seconds:
+                    self._flush()
+        except Exception as e:
+            logger.warning(f"[Summary] 录制事件失败: {e}")
+
+    def _flush(self):
+        """
+        把缓冲的事件作为一个完整的 gzip 成员追加到文件末尾
+
+        每批写完立即关闭成员，进程被杀死或崩溃时最多丢失缓冲中的事件，已写入的部分和重启后追加的部分都能正常读取
+        """
+        if self._pending:
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write("\n".join(self._pending) + "\n")
+            self._pending = []
+        self._last_flush = time.time()
+
+    def close(self):
+        try:
+            with self._lock:
+                self._flush()
+        except Exception as e:
+            logger.warning(f"[Summary] 写出录制事件失败: {e}")
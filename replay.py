@@ -0,0 +1,189 @@
+# encoding:utf-8
+"""
+线上消息流的离线回放
+
+录制（见 recorder 模块）：在 config.json 中设置 "replay_record_path"（如 "replay/events.jsonl.gz"），插件会把
+on_receive_message 和 on_handle_context 收到的事件脱敏后追加写入该文件（gzip 压缩的 JSONL）。
+
+回放：在 chatgpt-on-wechat 根目录下运行
+    python -m plugins.summary.replay replay/events.jsonl.gz
+    python -m plugins.summary.replay replay/events.jsonl.gz --profile replay.prof
+
+回放使用临时数据库、桩 channel 和桩 bot，不会发送任何消息或调用 LLM，
+按最快速度把事件依次交给插件处理，最后输出每个处理器的耗时分位数和性能分析结果。
+"""
+
+import argparse
+import cProfile
+import gzip
+import io
+import json
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common.log import logger
+from plugins import Event, EventContext
+
+from . import main as summary_main
+from .recorder import MSG_FIELDS
+
+
+class _ReplayMessage:
+    """回放用的 ChatMessage 替身"""
+
+    def __init__(self, fields):
+        for name, key in MSG_FIELDS.items():
+            setattr(self, name, fields.get(key))
+
+    def prepare(self):
+        pass
+
+
+class _ReplayChannel:
+    """回放用的 channel 替身，只统计发送次数"""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, reply, context):
+        self.sent += 1
+
+
+class _ReplayBridge:
+    """回放用的 Bridge 替身，不调用 LLM，直接返回固定长度的回复"""
+
+    calls = 0
+    prompt_chars = 0
+
+    def fetch_reply_content(self, query, context):
+        _ReplayBridge.calls += 1
+        _ReplayBridge.prompt_chars += len(query)
+        return Reply(ReplyType.TEXT, "1️⃣[回放][🔥]\n• 内容：回放桩回复")
+
+    def get_bot(self, typename):
+        # 桩 bot 不保存会话
+        return None
+
+
+def load_events(path):
+    """逐行读取录制文件，遇到不完整的 gzip 成员（旧版本录制时进程被中断）时停止读取"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except (EOFError, zlib.error, gzip.BadGzipFile, json.JSONDecodeError) as e:
+            logger.warning(f"[Summary] 录制文件 {path} 不完整，只回放之前的事件: {e}")
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def replay(path, profile_path=None, shift_time=True, top=30):
+    """
+    回放录制文件并输出报告
+
+    :param shift_time: 是否平移消息时间戳，使最后一条消息落在当前时间（"-2h" 等相对时间才能命中回放的数据）
+    """
+    events = list(load_events(path))
+    if not events:
+        print("录制文件为空", file=sys.stderr)
+        return
+    offset = 0
+    if shift_time:
+        last = max(event["m"].get("ts") or 0 for event in events)
+        offset = int(time.time()) - last if last else 0
+
+    workdir = tempfile.mkdtemp(prefix="summary_replay_")
+    original_load_config = summary_main.Summary._load_config
+    original_bridge = summary_main.Bridge
+
+    def load_replay_config(plugin):
+        config = original_load_config(plugin)
+        config.update({
+            "db_path": os.path.join(workdir, "chat.db"),
+            "replay_record_path": "",
+            "multimodal_llm_api_base": "",
+            "multimodal_llm_api_key": "",
+        })
+        return config
+
+    summary_main.Summary._load_config = load_replay_config
+    summary_main.Bridge = _ReplayBridge
+    timings = {"receive": [], "handle": []}
+    profiler = cProfile.Profile() if profile_path is not None else None
+    try:
+        plugin = summary_main.Summary()
+        channel = _ReplayChannel()
+        handlers = {"receive": (Event.ON_RECEIVE_MESSAGE, plugin.on_receive_message),
+                    "handle": (Event.ON_HANDLE_CONTEXT, plugin.on_handle_context)}
+
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        for event in events:
+            fields = dict(event["m"])
+            if fields.get("ts"):
+                fields["ts"] += offset
+            msg = _ReplayMessage(fields)
+            context = Context(ContextType[event["ct"]], event["c"],
+                              {"isgroup": event["grp"], "msg": msg, "session_id": msg.other_user_nickname})
+            event_type, handler = handlers[event["e"]]
+            e_context = EventContext(event_type, {"channel": channel, "context": context})
+            handler_start = time.perf_counter()
+            try:
+                handler(e_context)
+            except Exception as e:
+                logger.error(f"[Summary] 回放事件处理失败: {e}")
+            timings[event["e"]].append((time.perf_counter() - handler_start) * 1000)
+        if profiler:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+        plugin.store.close()
+    finally:
+        summary_main.Summary._load_config = original_load_config
+        summary_main.Bridge = original_bridge
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"回放 {len(events)} 个事件，耗时 {elapsed:.2f}s（{len(events) / elapsed:.0f} 事件/秒）")
+    print(f"bot 调用 {_ReplayBridge.calls} 次，提示词共 {_ReplayBridge.prompt_chars} 字符，channel 发送 {channel.sent} 次")
+    print(f"{'处理器':<10}{'次数':>8}{'p50(ms)':>10}{'p90(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for name, values in timings.items():
+        values.sort()
+        print(f"{name:<10}{len(values):>8}{_percentile(values, 50):>10.2f}{_percentile(values, 90):>10.2f}"
+              f"{_percentile(values, 99):>10.2f}{(values[-1] if values else 0):>10.2f}")
+
+    if profiler:
+        if profile_path:
+            profiler.dump_stats(profile_path)
+            print(f"性能分析结果已保存到 {profile_path}")
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(top)
+        print(stream.getvalue())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="回放录制的消息事件并输出性能报告")
+    parser.add_argument("path", help="录制文件（.jsonl.gz）")
+    parser.add_argument("--profile", nargs="?", const="", default=None,
+                        help="启用 cProfile；指定文件名时同时保存 .prof 文件")
+    parser.add_argument("--top", type=int, default=30, help="性能分析输出的函数数量")
+    parser.add_argument("--no-shift-time", action="store_true", help="不平移消息时间戳")
+    args = parser.parse_args(argv)
+    replay(args.path, profile_path=args.profile, shift_time=not args.no_shift_time, top=args.top)
+
+
+if __name__ == "__main__":
+    main()
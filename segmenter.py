@@ -0,0 +1,132 @@
+# encoding:utf-8
+
+from collections import deque
+
+from common.log import logger
+
+from .storage import BLOB_JOIN_SQL, CONTENT_LENGTH_SQL, estimate_record_tokens, estimate_tokens
+
+
+class _SegmentState:
+    """单个会话当前话题段的状态"""
+
+    __slots__ = ("segment_id", "last_timestamp", "recent_speakers", "speakers", "msg_count", "tokens")
+
+    def __init__(self, segment_id, last_timestamp):
+        self.segment_id = segment_id
+        self.last_timestamp = last_timestamp
+        self.recent_speakers = deque(maxlen=TopicSegmenter.RECENT_SPEAKERS)
+        self.speakers = set()
+        self.msg_count = 0
+        self.tokens = 0
+
+
+class TopicSegmenter:
+    """
+    写入时增量划分话题段，每条记录的 segment_id 即话题边界标记
+
+    划分规则（按优先级）：
+    1. 当前话题的 token 数超过 max_tokens，开启新话题，保证单个话题段能放进一个总结分段
+    2. 引用了当前话题段内发言人的消息（回复链）延续当前话题
+    3. 与上一条消息间隔超过 gap_minutes，开启新话题
+    4. 间隔超过 soft_gap_minutes，且当前话题已有 min_messages 条消息、发言人不在最近几位发言人中（发言人轮换），开启新话题
+
+    所有方法都需要在写事务中调用（由 ChatStore 的写锁保证串行）
+    """
+
+    RECENT_SPEAKERS = 5
+
+    def __init__(self, gap_minutes=30, soft_gap_minutes=5, min_messages=5, max_tokens=16000):
+        self.gap_seconds = gap_minutes * 60
+        self.soft_gap_seconds = soft_gap_minutes * 60
+        self.min_messages = min_messages
+        self.max_tokens = max_tokens
+        self._states = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """根据插件配置创建（实时写入和批量导入使用相同的划分参数）"""
+        return cls(gap_minutes=config.get("segment_gap_minutes", 30),
+                   soft_gap_minutes=config.get("segment_soft_gap_minutes", 5),
+                   min_messages=config.get("segment_min_messages", 5),
+                   max_tokens=config.get("chunk_max_tokens", 16000))
+
+    def _load_state(self, conn, session_id):
+        """从数据库恢复会话最近一个话题段的状态（重启后第一次写入时）"""
+        row = conn.execute("SELECT MAX(segment_id) FROM chat_records WHERE sessionid=?", (session_id,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        segment_id = row[0]
+        state = _SegmentState(segment_id, 0)
+        rows = conn.execute(f"SELECT r.user, {CONTENT_LENGTH_SQL}, r.timestamp FROM chat_records r {BLOB_JOIN_SQL} "
+                            "WHERE r.sessionid=? AND r.segment_id=? ORDER BY r.timestamp", (session_id, segment_id)).fetchall()
+        for user, content_length, timestamp in rows:
+            self._append(state, user, estimate_tokens(user, content_length), timestamp)
+        return state
+
+    def _append(self, state, user, tokens, timestamp):
+        state.last_timestamp = max(state.last_timestamp, timestamp)
+        if user:
+            state.speakers.add(user)
+            if not state.recent_speakers or state.recent_speakers[-1] != user:
+                state.recent_speakers.append(user)
+        state.msg_count += 1
+        state.tokens += tokens
+
+    def _is_boundary(self, state, user, tokens, timestamp, quoted_user):
+        gap = timestamp - state.last_timestamp
+        # token 上限优先于回复链，保证单个话题段能放进一个总结分段
+        if state.tokens + tokens > self.max_tokens:
+            return True
+        if quoted_user and quoted_user in state.speakers:
+            return False
+        if gap >= self.gap_seconds:
+            return True
+        return (gap >= self.soft_gap_seconds
+                and state.msg_count >= self.min_messages
+                and user not in state.recent_speakers)
+
+    def assign(self, conn, session_id, user, content, timestamp, quoted_user=None):
+        """
+        为新消息分配话题段
+
+        :return: segment_id
+        """
+        tokens = estimate_record_tokens(user, content)
+        state = self._states.get(session_id)
+        if state is None:
+            state = self._load_state(conn, session_id)
+        if state is None:
+            state = _SegmentState(1, timestamp)
+        elif self._is_boundary(state, user, tokens, timestamp, quoted_user):
+            logger.debug(f"[Summary] 新话题段: 会话={session_id}, segment_id={state.segment_id + 1}")
+            state = _SegmentState(state.segment_id + 1, timestamp)
+        self._states[session_id] = state
+        self._append(state, user, tokens, timestamp)
+        return state.segment_id
+
+    def rebuild(self, conn, session_ids=None):
+        """
+        按时间顺序重新划分会话的话题段（用于旧数据库升级和批量导入）
+
+        :param session_ids: 只重建指定会话，为 None 时重建全部会话
+        """
+        if session_ids is None:
+            session_ids = [row[0] for row in conn.execute("SELECT DISTINCT sessionid FROM chat_records").fetchall()]
+        for session_id in session_ids:
+            self._states.pop(session_id, None)
+            state = None
+            updates = []
+            rows = conn.execute(f"SELECT r.msgid, r.user, {CONTENT_LENGTH_SQL}, r.timestamp FROM chat_records r {BLOB_JOIN_SQL} "
+                                "WHERE r.sessionid=? ORDER BY r.timestamp, r.rowid", (session_id,))
+            for msg_id, user, content_length, timestamp in rows:
+                tokens = estimate_tokens(user, content_length)
+                if state is None:
+                    state = _SegmentState(1, timestamp)
+                elif self._is_boundary(state, user, tokens, timestamp, None):
+                    state = _SegmentState(state.segment_id + 1, timestamp)
+                self._append(state, user, tokens, timestamp)
+                updates.append((state.segment_id, session_id, msg_id))
+            conn.executemany("UPDATE chat_records SET segment_id=? WHERE sessionid=? AND msgid=?", updates)
+            if state is not None:
+                self._states[session_id] = state
@@ -0,0 +1,385 @@
+# encoding:utf-8
+
+import hashlib
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from common.log import logger
+
+
+class ChatStore:
+    """
+    聊天记录存储层
+
+    - 写入：单个写连接，所有写操作通过锁串行执行
+    - 读取：WAL 模式下每个线程一个只读连接，读操作在事务快照中执行，不会阻塞写入
+    """
+
+    def __init__(self, db_path, busy_timeout_ms=5000):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._closed = False
+
+        self._writer = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._configure(self._writer)
+        mode = self._writer.execute("PRAGMA journal_mode=WAL;").fetchone()[0]
+        if str(mode).lower() != "wal":
+            logger.warning(f"[Summary] 数据库未能切换到 WAL 模式，当前模式: {mode}")
+        self._writer.execute("PRAGMA synchronous=NORMAL;")
+
+    def _configure(self, conn):
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)};")
+
+    @contextmanager
+    def write(self):
+        """
+        获取写连接，块内的所有语句在同一个事务中提交
+
+        用法：
+            with store.write() as conn:
+                conn.execute(...)
+        """
+        with self._write_lock:
+            conn = self._writer
+            if conn.in_transaction:
+                # 嵌套调用：复用外层事务
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK;")
+                raise
+            else:
+                conn.execute("COMMIT;")
+
+    def _reader(self):
+        """获取当前线程的只读连接，不存在则创建"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            uri = f"file:{self.db_path}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+            self._configure(conn)
+            conn.execute("PRAGMA query_only=ON;")
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    @contextmanager
+    def read(self):
+        """
+        获取当前线程的只读连接，块内的所有查询看到同一个一致性快照
+
+        用法：
+            with store.read() as conn:
+                rows = conn.execute(...).fetchall()
+        """
+        conn = self._reader()
+        if conn.in_transaction:
+            # 嵌套调用：复用外层快照
+            yield conn
+            return
+        conn.execute("BEGIN;")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT;")
+
+    def execute(self, sql, params=()):
+        """执行单条写语句"""
+        with self.write() as conn:
+            return conn.execute(sql, params)
+
+    def query(self, sql, params=()):
+        """执行单条查询并返回全部结果"""
+        with self.read() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def close(self):
+        """关闭所有连接"""
+        if self._closed:
+            return
+        self._closed = True
+        with self._readers_lock:
+            for conn in self._readers:
+                try:
+                    conn.close()
+                except Exception as e:
+                    logger.warning(f"[Summary] 关闭只读连接失败: {e}")
+            self._readers.clear()
+        with self._write_lock:
+            self._writer.close()
+
+
+# chat_records 上的二级索引，批量导入时先删除、导入完成后重建
+RECORD_INDEXES = {
+    "idx_chat_records_session_time": "CREATE INDEX IF NOT EXISTS idx_chat_records_session_time ON chat_records (sessionid, timestamp)",
+    "idx_chat_records_session_segment": "CREATE INDEX IF NOT EXISTS idx_chat_records_session_segment ON chat_records (sessionid, segment_id)",
+}
+
+# 超过该长度（字符数）的消息内容压缩后存入 chat_blobs，按内容哈希去重，chat_records 中只保存引用
+BLOB_MIN_LENGTH = 512
+# 按原始内容计算长度的 SQL 片段，chat_records 需使用别名 r
+BLOB_JOIN_SQL = "LEFT JOIN chat_blobs b ON b.hash = r.content_ref"
+CONTENT_LENGTH_SQL = "length(coalesce(r.content, '')) + coalesce(b.size, 0)"
+
+
+def init_schema(conn):
+    """创建/升级数据库架构，需在写事务中调用"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_records
+                (sessionid TEXT, msgid INTEGER, user TEXT, content TEXT, type TEXT, timestamp INTEGER, is_triggered INTEGER,
+                PRIMARY KEY (sessionid, msgid))''')
+    
+    # 检查 is_triggered 列是否存在
+    c = conn.execute("PRAGMA table_info(chat_records);")
+    column_exists = False
+    for column in c.fetchall():
+        if column[1] == 'is_triggered':
+            column_exists = True
+            break
+    if not column_exists:
+        conn.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0;")
+        conn.execute("UPDATE chat_records SET is_triggered = 0;")
+
+    # 检查 segment_id 列（话题段）是否存在，旧记录的话题段由 TopicSegmenter.rebuild 补齐
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(chat_records);").fetchall()]
+    if 'segment_id' not in columns:
+        conn.execute("ALTER TABLE chat_records ADD COLUMN segment_id INTEGER;")
+
+    # 长消息内容按哈希存放在 chat_blobs 中，content_ref 为引用的哈希，content 为空
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_blobs
+                (hash TEXT PRIMARY KEY, codec TEXT, size INTEGER, data BLOB)''')
+    if 'content_ref' not in columns:
+        conn.execute("ALTER TABLE chat_records ADD COLUMN content_ref TEXT;")
+        moved = pack_long_contents(conn)
+        if moved:
+            logger.info(f"[Summary] 已将 {moved} 条长消息内容移入 chat_blobs，可执行 VACUUM 回收磁盘空间")
+
+    create_record_indexes(conn)
+
+    # 按 (会话, 小时) 汇总的活跃度统计，写入时增量维护
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_hourly_stats
+                (sessionid TEXT, hour INTEGER, msg_count INTEGER DEFAULT 0, token_sum INTEGER DEFAULT 0,
+                speaker_count INTEGER DEFAULT 0, trigger_count INTEGER DEFAULT 0,
+                PRIMARY KEY (sessionid, hour))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_hourly_speakers
+                (sessionid TEXT, hour INTEGER, user TEXT,
+                PRIMARY KEY (sessionid, hour, user))''')
+
+    # 按需识图模式下待识别的图片
+    conn.execute('''CREATE TABLE IF NOT EXISTS image_pending
+                (sessionid TEXT, msgid INTEGER, user TEXT, image_path TEXT, timestamp INTEGER, status TEXT,
+                PRIMARY KEY (sessionid, msgid))''')
+
+    # 后台总结任务（summary_async_jobs 模式）
+    conn.execute('''CREATE TABLE IF NOT EXISTS summary_jobs
+                (job_id TEXT PRIMARY KEY, sessionid TEXT, requester TEXT, params TEXT, status TEXT,
+                result TEXT, error TEXT, created_at INTEGER, updated_at INTEGER)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_summary_jobs_requester ON summary_jobs (requester, created_at)")
+
+    # 已结束的小时/天/周的总结（多粒度总结），msg_count 为生成时周期内的消息数
+    conn.execute('''CREATE TABLE IF NOT EXISTS summary_pyramid
+                (sessionid TEXT, level TEXT, period_start INTEGER, period_end INTEGER, msg_count INTEGER,
+                summary TEXT, created_at INTEGER,
+                PRIMARY KEY (sessionid, level, period_start))''')
+
+    # 旧数据库升级：统计表为空但已有聊天记录时，一次性重建
+    has_stats = conn.execute("SELECT 1 FROM chat_hourly_stats LIMIT 1").fetchone()
+    has_records = conn.execute("SELECT 1 FROM chat_records LIMIT 1").fetchone()
+    if has_records and not has_stats:
+        logger.info("[Summary] 正在根据已有聊天记录重建小时统计表")
+        rebuild_hourly_stats(conn)
+
+
+def create_record_indexes(conn):
+    """创建 chat_records 的二级索引"""
+    for sql in RECORD_INDEXES.values():
+        conn.execute(sql)
+
+
+def drop_record_indexes(conn):
+    """删除 chat_records 的二级索引（批量导入前调用）"""
+    for name in RECORD_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def _compress(content):
+    """压缩消息内容，返回 (codec, data)；压缩后没有变小时原样保存"""
+    raw = content.encode("utf-8")
+    data = zlib.compress(raw, 6)
+    if len(data) >= len(raw):
+        return "raw", raw
+    return "zlib", data
+
+
+def _decompress(codec, data):
+    if codec == "zlib":
+        data = zlib.decompress(data)
+    elif codec != "raw":
+        raise ValueError(f"未知的 blob 编码: {codec}")
+    return data.decode("utf-8")
+
+
+def store_content(conn, content, min_length=BLOB_MIN_LENGTH):
+    """
+    按长度决定消息内容的存放位置，需在写事务中调用
+
+    :return: (写入 chat_records.content 的值, 写入 chat_records.content_ref 的值)
+    """
+    if not content or len(content) < min_length:
+        return content, None
+    ref = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    # 相同内容（如转发到多个群的文章）只压缩和保存一次
+    if not conn.execute("SELECT 1 FROM chat_blobs WHERE hash=?", (ref,)).fetchone():
+        codec, data = _compress(content)
+        conn.execute("INSERT INTO chat_blobs (hash, codec, size, data) VALUES (?,?,?,?)",
+                     (ref, codec, len(content), data))
+    return "", ref
+
+
+def pack_long_contents(conn, min_length=BLOB_MIN_LENGTH):
+    """
+    将 chat_records 中内联保存的长消息内容移入 chat_blobs（用于旧数据库升级和批量导入）
+
+    :return: 移动的记录数
+    """
+    rows = conn.execute("SELECT rowid, content FROM chat_records WHERE content_ref IS NULL AND length(content)>=?",
+                        (min_length,)).fetchall()
+    updates = []
+    for rowid, content in rows:
+        content, ref = store_content(conn, content, min_length)
+        updates.append((content, ref, rowid))
+    conn.executemany("UPDATE chat_records SET content=?, content_ref=? WHERE rowid=?", updates)
+    return len(updates)
+
+
+def gc_blobs(conn):
+    """删除不再被任何记录引用的 blob（记录被覆盖写入后可能残留），需在写事务中调用"""
+    c = conn.execute("DELETE FROM chat_blobs WHERE hash NOT IN "
+                     "(SELECT content_ref FROM chat_records WHERE content_ref IS NOT NULL)")
+    return c.rowcount
+
+
+class BlobCache:
+    """
+    解压后的 blob 内容缓存（LRU），按条数和总字符数限制大小
+
+    最近的长消息通常会被连续的总结请求重复读取，缓存后不必每次解压
+    """
+
+    def __init__(self, max_entries=256, max_chars=2 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._chars = 0
+
+    def get(self, conn, ref):
+        """读取 blob 内容，缓存未命中时从数据库读取并解压"""
+        with self._lock:
+            content = self._entries.get(ref)
+            if content is not None:
+                self._entries.move_to_end(ref)
+                return content
+
+        row = conn.execute("SELECT codec, data FROM chat_blobs WHERE hash=?", (ref,)).fetchone()
+        if not row:
+            logger.warning(f"[Summary] 找不到消息内容 blob: {ref}")
+            return ""
+        content = _decompress(row[0], row[1])
+        if len(content) > self.max_chars:
+            return content
+
+        with self._lock:
+            if ref not in self._entries:
+                self._entries[ref] = content
+                self._chars += len(content)
+                while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._chars -= len(evicted)
+        return content
+
+    def resolve(self, conn, records):
+        """
+        将 SELECT * 得到的记录中引用 blob 的内容替换为原始内容
+
+        :return: 记录列表，记录布局不变（content 为原始内容）
+        """
+        resolved = []
+        for record in records:
+            ref = record[8] if len(record) > 8 else None
+            if ref:
+                record = record[:3] + (self.get(conn, ref),) + record[4:]
+            resolved.append(record)
+        return resolved
+
+
+def estimate_tokens(user, content_length):
+    """按发言人和内容长度粗略估计 token 数，见 estimate_record_tokens"""
+    return (len(user or "") + content_length + 30) // 4
+
+
+def estimate_record_tokens(user, content):
+    """
+    粗略估计一条记录在聊天记录文本中占用的 token 数
+
+    与总结时的估算方式一致（约 4 个字符 1 个 token），30 为时间戳、引号等格式字符
+    """
+    return estimate_tokens(user, len(content or ""))
+
+
+def update_hourly_stats(conn, session_id, user, content, timestamp, is_triggered, sign=1):
+    """增量更新 (会话, 小时) 统计，sign=-1 表示扣除"""
+    hour = int(timestamp) // 3600 * 3600
+    tokens = estimate_record_tokens(user, content)
+    triggered = 1 if is_triggered else 0
+    conn.execute('''INSERT INTO chat_hourly_stats (sessionid, hour, msg_count, token_sum, trigger_count)
+                    VALUES (?,?,?,?,?)
+                    ON CONFLICT(sessionid, hour) DO UPDATE SET
+                        msg_count = msg_count + excluded.msg_count,
+                        token_sum = token_sum + excluded.token_sum,
+                        trigger_count = trigger_count + excluded.trigger_count''',
+                 (session_id, hour, sign, sign * tokens, sign * triggered))
+    # 发言人只增不减：覆盖写入时不回收旧发言人，统计略有偏高可接受
+    if sign > 0 and user:
+        c = conn.execute("INSERT OR IGNORE INTO chat_hourly_speakers VALUES (?,?,?)", (session_id, hour, user))
+        if c.rowcount:
+            conn.execute("UPDATE chat_hourly_stats SET speaker_count = speaker_count + 1 WHERE sessionid=? AND hour=?",
+                         (session_id, hour))
+
+
+def rebuild_hourly_stats(conn, session_ids=None):
+    """
+    根据 chat_records 重建小时统计（用于旧数据库升级和批量导入）
+
+    :param session_ids: 只重建指定会话，为 None 时全量重建
+    """
+    if session_ids is None:
+        where, params = "", ()
+    else:
+        session_ids = list(session_ids)
+        if not session_ids:
+            return
+        where = f"WHERE sessionid IN ({','.join('?' * len(session_ids))})"
+        params = tuple(session_ids)
+    conn.execute(f"DELETE FROM chat_hourly_stats {where}", params)
+    conn.execute(f"DELETE FROM chat_hourly_speakers {where}", params)
+    conn.execute(f"""INSERT INTO chat_hourly_speakers
+                    SELECT DISTINCT sessionid, timestamp / 3600 * 3600, user FROM chat_records
+                    {where + ' AND' if where else 'WHERE'} user IS NOT NULL AND user != ''""", params)
+    # token 数按原始内容长度计算，长消息的长度取自 chat_blobs.size
+    conn.execute(f"""INSERT INTO chat_hourly_stats
+                    SELECT sessionid, timestamp / 3600 * 3600 AS hour, COUNT(*),
+                        SUM((length(coalesce(user, '')) + {CONTENT_LENGTH_SQL} + 30) / 4),
+                        COUNT(DISTINCT CASE WHEN user != '' THEN user END),
+                        SUM(CASE WHEN is_triggered THEN 1 ELSE 0 END)
+                    FROM chat_records r {BLOB_JOIN_SQL} {where} GROUP BY sessionid, hour""", params)
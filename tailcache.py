@@ -0,0 +1,173 @@
+# encoding:utf-8
+
+import threading
+from collections import OrderedDict, deque
+
+TIMESTAMP = 5
+MSGID = 1
+CONTENT = 3
+
+
+class _SessionTail:
+    """单个会话最近的消息，按时间正序排列"""
+
+    __slots__ = ("records", "msg_ids", "complete_after", "chars")
+
+    def __init__(self, complete_after):
+        self.records = deque()
+        self.msg_ids = set()
+        # 时间戳大于 complete_after 的记录全部在缓存中
+        self.complete_after = complete_after
+        self.chars = 0
+
+
+class TailCache:
+    """
+    活跃会话最近消息的内存缓存
+
+    每个会话保留最近 max_messages 条消息，以及最近 max_minutes 分钟内的全部消息；
+    所有会话的消息总数超过 max_total_messages 或内容总字符数超过 max_total_chars 时，
+    淘汰最久未访问的会话。
+
+    会话第一次写入时从空缓存开始（不从数据库加载历史记录），之后由 _insert_record 填充；
+    查询的时间窗口完全落在缓存覆盖范围内时直接返回，否则返回 None，由调用方回退到数据库查询
+    """
+
+    def __init__(self, max_messages=500, max_minutes=180, max_total_messages=50000, max_total_chars=32 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.max_seconds = max_minutes * 60
+        self.max_total_messages = max_total_messages
+        self.max_total_chars = max_total_chars
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._total_messages = 0
+        self._total_chars = 0
+        self.hits = 0
+        self.misses = 0
+
+    def has(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def start(self, session_id, complete_after):
+        """
+        开始缓存会话：之后写入的记录进入缓存
+
+        :param complete_after: 数据库中该会话当前最新记录的时间戳（没有记录时为 -1），
+            只有时间窗口在它之后的查询可以由缓存回答
+        """
+        with self._lock:
+            self._drop(session_id)
+            self._sessions[session_id] = _SessionTail(complete_after)
+            self._evict_sessions()
+
+    def put(self, session_id, record):
+        """写入一条记录，相同消息ID的记录会被替换（如图片识别结果），只对已缓存的会话生效"""
+        with self._lock:
+            tail = self._sessions.get(session_id)
+            if tail is None:
+                return
+            self._sessions.move_to_end(session_id)
+            self._remove_msg(tail, record[MSGID])
+            if record[TIMESTAMP] > tail.complete_after:
+                self._insert(tail, record)
+            self._trim(tail)
+            self._evict_sessions()
+
+    def invalidate(self, session_id):
+        """丢弃会话缓存（写入失败等缓存可能与数据库不一致时）"""
+        with self._lock:
+            self._drop(session_id)
+
+    def get(self, session_id, start_timestamp=0, limit=9999):
+        """
+        按 _get_records 的语义查询：时间戳大于 start_timestamp 的最新 limit 条记录，按时间倒序
+
+        :return: 记录列表；缓存无法完整覆盖查询范围时返回 None
+        """
+        with self._lock:
+            tail = self._sessions.get(session_id)
+            if tail is None:
+                self.misses += 1
+                return None
+            result = []
+            for record in reversed(tail.records):
+                if record[TIMESTAMP] <= start_timestamp or len(result) >= limit:
+                    break
+                result.append(record)
+            # 窗口起点在覆盖范围内，或者覆盖范围内的记录已经够 limit 条
+            if start_timestamp >= tail.complete_after or len(result) >= limit:
+                self._sessions.move_to_end(session_id)
+                self.hits += 1
+                return result
+            self.misses += 1
+            return None
+
+    def stats(self):
+        """(缓存的会话数, 缓存的消息数, 命中次数, 未命中次数)"""
+        with self._lock:
+            return len(self._sessions), self._total_messages, self.hits, self.misses
+
+    @staticmethod
+    def _record_chars(record):
+        return len(record[CONTENT] or "")
+
+    def _insert(self, tail, record):
+        records = tail.records
+        # 通常是最新的消息，直接追加；乱序到达时从尾部向前找到插入位置
+        index = len(records)
+        while index and records[index - 1][TIMESTAMP] > record[TIMESTAMP]:
+            index -= 1
+        records.insert(index, record)
+        tail.msg_ids.add(record[MSGID])
+        chars = self._record_chars(record)
+        tail.chars += chars
+        self._total_messages += 1
+        self._total_chars += chars
+
+    def _remove_msg(self, tail, msg_id):
+        if msg_id not in tail.msg_ids:
+            return
+        tail.msg_ids.discard(msg_id)
+        for index in range(len(tail.records) - 1, -1, -1):
+            record = tail.records[index]
+            if record[MSGID] == msg_id:
+                del tail.records[index]
+                chars = self._record_chars(record)
+                tail.chars -= chars
+                self._total_messages -= 1
+                self._total_chars -= chars
+                return
+
+    def _pop_oldest(self, tail):
+        record = tail.records.popleft()
+        tail.msg_ids.discard(record[MSGID])
+        tail.complete_after = max(tail.complete_after, record[TIMESTAMP])
+        chars = self._record_chars(record)
+        tail.chars -= chars
+        self._total_messages -= 1
+        self._total_chars -= chars
+
+    def _trim(self, tail):
+        """超过 max_messages 条时，淘汰超出 max_minutes 时间范围的最早记录"""
+        records = tail.records
+        while len(records) > self.max_messages and records[0][TIMESTAMP] < records[-1][TIMESTAMP] - self.max_seconds:
+            self._pop_oldest(tail)
+
+    def _drop(self, session_id):
+        tail = self._sessions.pop(session_id, None)
+        if tail is not None:
+            self._total_messages -= len(tail.records)
+            self._total_chars -= tail.chars
+
+    def _over_limit(self):
+        return self._total_messages > self.max_total_messages or self._total_chars > self.max_total_chars
+
+    def _evict_sessions(self):
+        while len(self._sessions) > 1 and self._over_limit():
+            self._drop(next(iter(self._sessions)))
+        # 只剩一个会话仍然超出上限时，只保留最近 max_messages 条
+        if self._sessions and self._over_limit():
+            tail = next(reversed(self._sessions.values()))
+            while len(tail.records) > self.max_messages and self._over_limit():
+                self._pop_oldest(tail)
@@ -0,0 +1,135 @@
+# encoding:utf-8
+"""SingleFlight 的合并行为与 AdmissionController 的排队顺序"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from concurrency import AdmissionController, SingleFlight  # noqa: E402
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def _wait_until(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("等待超时")
+        time.sleep(0.005)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            release.wait(2)
+            return "结果"
+
+        leader = _start(lambda: results.append(flight.do("k", work)))
+        _wait_until(lambda: calls)
+        joined = threading.Event()
+        followers = [_start(lambda: results.append(flight.do("k", work, on_join=joined.set))) for _ in range(3)]
+        _wait_until(joined.is_set)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(2)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("结果", False)] + [("结果", True)] * 3)
+        self.assertEqual(flight.inflight_count(), 0)
+
+    def test_exception_is_shared_and_key_is_released(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError("失败")
+
+        with self.assertRaises(ValueError):
+            flight.do("k", fail)
+        self.assertEqual(flight.do("k", lambda: 1), (1, False))
+
+    def test_different_keys_run_separately(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do("a", lambda: 1), (1, False))
+        self.assertEqual(flight.do("b", lambda: 2), (2, False))
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def acquire_async(self, admission, session_id, events, timeout=2):
+        def run():
+            admitted = admission.acquire(session_id, on_queued=lambda position: events.append((session_id, "排队", position)),
+                                         timeout=timeout)
+            events.append((session_id, "运行" if admitted else "超时"))
+        return _start(run)
+
+    def test_queue_is_first_come_first_served(self):
+        admission = AdmissionController(global_limit=1, session_limit=1)
+        events = []
+        self.assertTrue(admission.acquire("A"))
+        b = self.acquire_async(admission, "B", events)
+        _wait_until(lambda: ("B", "排队", 1) in events)
+        c = self.acquire_async(admission, "C", events)
+        _wait_until(lambda: ("C", "排队", 2) in events)
+
+        admission.release("A")
+        _wait_until(lambda: ("B", "运行") in events)
+        self.assertNotIn(("C", "运行"), events)
+        admission.release("B")
+        c.join(2)
+        b.join(2)
+        self.assertEqual(events[-1], ("C", "运行"))
+
+    def test_request_blocked_by_own_session_does_not_block_others(self):
+        admission = AdmissionController(global_limit=2, session_limit=1)
+        events = []
+        self.assertTrue(admission.acquire("A"))
+        a2 = self.acquire_async(admission, "A", events)
+        _wait_until(lambda: ("A", "排队", 1) in events)
+
+        # A 的第二个请求只受会话限制阻塞，B 可以立即运行，且不会收到排队提示
+        self.assertTrue(admission.acquire("B", on_queued=lambda position: events.append(("B", "排队", position))))
+        self.assertNotIn(("B", "排队", 1), events)
+        self.assertNotIn(("B", "排队", 2), events)
+
+        # 名额已满时，C 的排队位置不计算受会话限制阻塞的 A
+        c = self.acquire_async(admission, "C", events)
+        _wait_until(lambda: any(event[:2] == ("C", "排队") for event in events))
+        self.assertIn(("C", "排队", 1), events)
+
+        admission.release("B")
+        _wait_until(lambda: ("C", "运行") in events)
+        admission.release("A")
+        _wait_until(lambda: ("A", "运行") in events)
+        for thread in (a2, c):
+            thread.join(2)
+        self.assertEqual(admission.status(), (2, 0))
+
+    def test_full_queue_and_timeout(self):
+        admission = AdmissionController(global_limit=1, session_limit=1, max_queue=1)
+        events = []
+        self.assertTrue(admission.acquire("A"))
+        b = self.acquire_async(admission, "B", events, timeout=0.2)
+        _wait_until(lambda: ("B", "排队", 1) in events)
+        self.assertFalse(admission.acquire("C"))
+        b.join(2)
+        self.assertEqual(events[-1], ("B", "超时"))
+        self.assertEqual(admission.status(), (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
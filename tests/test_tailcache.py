@@ -0,0 +1,95 @@
+# encoding:utf-8
+"""
+最近消息缓存与数据库查询的一致性检查
+
+按 _write_record 的方式写入（会话第一次写入时以当前最新时间戳开始缓存、乱序到达、同一消息ID覆盖写入），
+期间随机丢弃会话缓存并用较小的上限触发淘汰，然后随机查询：缓存命中时结果必须与 SQLite 完全一致
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tailcache import TailCache  # noqa: E402
+
+SESSIONS = ("群A", "群B", "群C", "用户D")
+
+
+class TailCacheConsistencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE chat_records (sessionid TEXT, msgid INTEGER, user TEXT, content TEXT, type TEXT, "
+                          "timestamp INTEGER, is_triggered INTEGER, segment_id INTEGER, content_ref TEXT, "
+                          "PRIMARY KEY (sessionid, msgid))")
+        self.cache = TailCache(max_messages=20, max_minutes=30, max_total_messages=120, max_total_chars=6000)
+
+    def write(self, session_id, msg_id, content, timestamp):
+        """与 _write_record 相同的缓存维护方式"""
+        if not self.cache.has(session_id):
+            latest = self.conn.execute("SELECT MAX(timestamp) FROM chat_records WHERE sessionid=?", (session_id,)).fetchone()[0]
+            self.cache.start(session_id, -1 if latest is None else latest)
+        c = self.conn.execute("INSERT OR REPLACE INTO chat_records VALUES (?,?,?,?,?,?,?,?,?)",
+                              (session_id, msg_id, "u%d" % (msg_id % 5), content, "TEXT", timestamp, 0, None, None))
+        record = self.conn.execute("SELECT * FROM chat_records WHERE rowid=?", (c.lastrowid,)).fetchone()
+        self.cache.put(session_id, record)
+
+    def query(self, session_id, start_timestamp, limit):
+        return self.conn.execute("SELECT * FROM chat_records WHERE sessionid=? and timestamp>? ORDER BY timestamp DESC LIMIT ?",
+                                 (session_id, start_timestamp, limit)).fetchall()
+
+    def test_hits_match_database(self):
+        rng = random.Random(20261019)
+        # 时间戳互不相同，避免同一秒内多条记录的顺序在两边不确定
+        timestamps = rng.sample(range(1_000_000, 1_100_000), 3000)
+        written = {session_id: {} for session_id in SESSIONS}
+        next_id = 0
+        for i, timestamp in enumerate(sorted(timestamps)):
+            session_id = rng.choice(SESSIONS)
+            roll = rng.random()
+            if roll < 0.1 and written[session_id]:
+                # 覆盖写入已有消息（如图片识别结果），时间戳不变
+                msg_id = rng.choice(list(written[session_id]))
+                timestamp = written[session_id][msg_id]
+            else:
+                msg_id = next_id
+                next_id += 1
+                if roll < 0.2:
+                    # 乱序到达：时间戳早于最近写入的消息
+                    timestamp -= rng.randint(1, 5000)
+                    while timestamp in timestamps or any(timestamp in w.values() for w in written.values()):
+                        timestamp -= 1
+            written[session_id][msg_id] = timestamp
+            self.write(session_id, msg_id, "消息%d-%s" % (i, "x" * rng.randint(0, 80)), timestamp)
+            if rng.random() < 0.01:
+                self.cache.invalidate(rng.choice(SESSIONS))
+
+        hits = 0
+        for _ in range(2000):
+            session_id = rng.choice(SESSIONS)
+            start_timestamp = rng.choice((0, rng.randint(999_000, 1_100_000)))
+            limit = rng.choice((9999, rng.randint(1, 60)))
+            cached = self.cache.get(session_id, start_timestamp, limit)
+            if cached is not None:
+                hits += 1
+                self.assertEqual(cached, self.query(session_id, start_timestamp, limit),
+                                 (session_id, start_timestamp, limit))
+        self.assertGreater(hits, 100)
+
+    def test_first_write_starts_after_existing_records(self):
+        for msg_id in range(5):
+            self.conn.execute("INSERT INTO chat_records VALUES (?,?,?,?,?,?,?,?,?)",
+                              ("群A", msg_id, "u", "旧消息", "TEXT", 100 + msg_id, 0, None, None))
+        self.write("群A", 10, "新消息", 200)
+        # 窗口在缓存开始之后：命中；窗口包含缓存之前的记录：回退到数据库
+        self.assertEqual(self.cache.get("群A", 104), self.query("群A", 104, 9999))
+        self.assertIsNone(self.cache.get("群A", 0))
+        self.assertEqual(self.cache.get("群A", 0, limit=1), self.query("群A", 0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# encoding:utf-8
+"""
+紧凑的聊天记录文本格式
+
+    发言人（代号=昵称，总结中请使用昵称）：A=张三 B=李四
+    ## 2024-05-01
+    【话题1】
+    09:15 A: 早上好
+    09:16 B: 今天开会吗 <T>
+
+相比每行重复完整时间戳和昵称，发言人只声明一次、日期按天分组、时间精确到分钟，
+可以显著减少 token 数
+"""
+
+import string
+import time
+
+from bridge.context import ContextType
+
+MEDIA_TYPES = (str(ContextType.IMAGE), str(ContextType.VOICE))
+SPEAKER_HEADER = "发言人（代号=昵称，总结中请使用昵称）："
+# 每行固定开销："HH:MM " + ": " + 换行，代号按 2 个字符估算
+LINE_OVERHEAD = 11
+TRIGGER_MARK = " <T>"
+
+
+def speaker_alias(index):
+    """第 index 个发言人的代号：A-Z，之后为 A1-Z1、A2-Z2……"""
+    letter = string.ascii_uppercase[index % 26]
+    return letter if index < 26 else f"{letter}{index // 26}"
+
+
+def record_text(record):
+    """记录的消息内容，图片和语音显示为 [类型]"""
+    if record[4] in MEDIA_TYPES:
+        return f"[{record[4]}]"
+    return record[3] or ""
+
+
+def estimate_line_length(record):
+    """估计一条记录在紧凑格式中占用的字符数（不含发言人声明）"""
+    length = len(record_text(record)) + LINE_OVERHEAD
+    if record[6]:
+        length += len(TRIGGER_MARK)
+    return length
+
+
+def estimate_speaker_length(user):
+    """估计一个发言人在发言人声明中占用的字符数"""
+    return len(user or "") + 4
+
+
+def render_transcript(groups):
+    """
+    将按话题段分组的记录渲染为紧凑格式的聊天记录文本
+
+    :param groups: 按时间正序排列的 [(segment_id, [record, ...]), ...]，组内记录也按时间正序
+    :return: 聊天记录文本
+    """
+    aliases = {}
+    lines = []
+    last_date = None
+    mark_topics = len(groups) > 1
+    for i, (_, records) in enumerate(groups):
+        if mark_topics:
+            lines.append(f"【话题{i + 1}】")
+        for record in records:
+            user = record[2] or ""
+            alias = aliases.get(user)
+            if alias is None:
+                alias = aliases[user] = speaker_alias(len(aliases))
+
+            local = time.localtime(record[5])
+            date = time.strftime("%Y-%m-%d", local)
+            if date != last_date:
+                lines.append(f"## {date}")
+                last_date = date
+
+            line = f"{time.strftime('%H:%M', local)} {alias}: {record_text(record)}"
+            if record[6]:
+                line += TRIGGER_MARK
+            lines.append(line)
+
+    header = SPEAKER_HEADER + " ".join(f"{alias}={user or '未知'}" for user, alias in aliases.items())
+    return header + "\n" + "\n".join(lines)